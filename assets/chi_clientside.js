@@ -0,0 +1,141 @@
+// Clientside versions of the callbacks in chi_controller.py, used when the app runs with CHI_CLIENTSIDE=1
+// Each function receives the precomputed results for the selected dataset in pair-store (see chi_model.clientside_data) as its final argument
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    chi: (function () {
+        var formatted = {locale: {}, nully: "", prefix: null, specifier: ".2%"};
+
+        // Observed counts with row/column totals for a pair
+        function totals(pair) {
+            var rowTotals = pair.counts.map(function (row) {
+                return row.reduce(function (a, b) { return a + b; }, 0);
+            });
+            var colTotals = pair.ind_cat.map(function (_, j) {
+                return pair.counts.reduce(function (a, row) { return a + row[j]; }, 0);
+            });
+            var total = rowTotals.reduce(function (a, b) { return a + b; }, 0);
+            return {rows: rowTotals, cols: colTotals, total: total};
+        }
+
+        // Row order of the DataTables (dependent categories, which come sorted, in descending order)
+        function descending(labels) {
+            return labels.map(function (_, i) { return i; }).reverse();
+        }
+
+        function span(children, className) {
+            var props = {children: children};
+            if (className) {
+                props.className = className;
+            }
+            return {namespace: "dash_html_components", type: "Span", props: props};
+        }
+
+        function conclusion(acceptReject, p, alpha, level) {
+            if (acceptReject === null || acceptReject === undefined) {
+                return "";
+            }
+            var reject = p < alpha;
+            var correct = (acceptReject === "reject") === reject;
+            var text = reject ?
+                " - " + p.toFixed(3) + " is less than " + alpha + ", so we reject the null hypothesis at the " + level + " confidence level" :
+                " - " + p.toFixed(3) + " is greater than " + alpha + ", so we accept the null hypothesis at the " + level + " confidence level";
+            return [span(correct ? "Correct" : "Incorrect", "bold-p"), span([text])];
+        }
+
+        return {
+            update_bar: function (n_clicks, dependent, independent, dataset, store) {
+                var no_update = window.dash_clientside.no_update;
+                if (n_clicks === null || n_clicks === undefined) {
+                    throw window.dash_clientside.PreventUpdate;
+                }
+                if (dependent === independent) {
+                    return [no_update, no_update, no_update, no_update, no_update, true];
+                }
+                var pair = store.pairs[dependent + "|" + independent];
+                var t = totals(pair);
+                var x = pair.ind_cat.concat(["Expected"]);
+                var data = pair.dep_cat.map(function (category, i) {
+                    var y = pair.counts[i].map(function (count, j) { return count / t.cols[j]; });
+                    y.push(t.rows[i] / t.total);
+                    return {type: "bar",
+                            name: category,
+                            x: x,
+                            y: y,
+                            marker: {color: store.colours[dependent][category], opacity: 0.7},
+                            hovertemplate: "Proportion: %{y:.2%}<extra></extra>"};
+                });
+                var fig = {
+                    data: data,
+                    layout: {template: store.template,
+                             barmode: "stack",
+                             margin: {t: 20, b: 10, l: 20, r: 20},
+                             height: 400,
+                             font: {size: 14},
+                             dragmode: false,
+                             legend: {title: {text: dependent, font: {size: 14}}},
+                             xaxis: {type: "category", tick0: x[0], dtick: 1, title: {text: independent}},
+                             yaxis: {title: {text: "Proportion (" + dependent + ")"}, range: [0, 1]}}
+                };
+                var sr_text = "Bar chart of dependent variable " + dependent + " for independent variable " + independent;
+                return [fig, sr_text, pair.p.toFixed(3), pair.p, {display: "inline"}, false];
+            },
+
+            update_results: function (n_clicks, dependent, independent) {
+                var no_update = window.dash_clientside.no_update;
+                if (n_clicks === null || n_clicks === undefined) {
+                    throw window.dash_clientside.PreventUpdate;
+                }
+                if (dependent === independent) {
+                    return [no_update, no_update, no_update, no_update, true, true];
+                }
+                var null_hyp = "The value of " + dependent + " does not depend on " + independent + " - there is no association between the variables";
+                var alt_hyp = "The value of " + dependent + " does depend on " + independent + " - there is an association between the variables";
+                return [null_hyp, alt_hyp, null, null, false, false];
+            },
+
+            update_datatables: function (n_clicks, dependent, independent, dataset, store) {
+                var no_update = window.dash_clientside.no_update;
+                if (n_clicks === null || n_clicks === undefined) {
+                    throw window.dash_clientside.PreventUpdate;
+                }
+                if (dependent === independent) {
+                    return [no_update, no_update, no_update, no_update, no_update, no_update];
+                }
+                var pair = store.pairs[dependent + "|" + independent];
+                var t = totals(pair);
+                var order = descending(pair.dep_cat);
+                var names = pair.ind_cat.concat(["Total"]);
+                var pcNames = pair.ind_cat.concat(["Expected"]).map(function (c) {
+                    return store.pc_labels.hasOwnProperty(c) ? store.pc_labels[c] : c;
+                });
+                var obs = [], exp = [], obs_pc = [];
+                order.forEach(function (i) {
+                    var obsRow = {}, expRow = {}, pcRow = {};
+                    pair.ind_cat.forEach(function (_, j) {
+                        obsRow[names[j]] = pair.counts[i][j];
+                        expRow[names[j]] = pair.expected[i][j];
+                        pcRow[pcNames[j]] = pair.counts[i][j] / t.cols[j];
+                    });
+                    obsRow.Total = t.rows[i];
+                    expRow.Total = pair.expected[i][pair.ind_cat.length];
+                    pcRow[pcNames[pair.ind_cat.length]] = t.rows[i] / t.total;
+                    obs.push(obsRow);
+                    exp.push(expRow);
+                    obs_pc.push(pcRow);
+                });
+                var columns = names.map(function (c) { return {name: c, id: c}; });
+                var pcColumns = pcNames.map(function (c) {
+                    return {name: c, id: c, type: "numeric", format: formatted};
+                });
+                return [obs, columns, exp, columns, obs_pc, pcColumns];
+            },
+
+            accept_or_reject95: function (accept_reject, p) {
+                return conclusion(accept_reject, p, 0.05, "95%");
+            },
+
+            accept_or_reject99: function (accept_reject, p) {
+                return conclusion(accept_reject, p, 0.01, "99%");
+            }
+        };
+    })()
+});
@@ -0,0 +1,270 @@
+# Benchmark suite for the model, the Dash callbacks and the app end to end
+# Run from the repository root:
+#   python benchmarks/bench_app.py                              all layers with default sizes
+#   python benchmarks/bench_app.py model --rows 1000,1000000    model microbenchmarks on synthetic data
+#   python benchmarks/bench_app.py callbacks                    every chi_controller callback called directly
+#   python benchmarks/bench_app.py load --users 16              concurrent _dash-update-component requests through Flask's test client
+#   python benchmarks/bench_app.py load --url http://localhost:8080   the same requests against a running server (e.g. gunicorn)
+#   python benchmarks/bench_app.py startup                      cold start - import time, first page load and first submit in a new process
+#   python benchmarks/bench_app.py --save-baseline benchmarks/baseline.json
+#   python benchmarks/bench_app.py --compare benchmarks/baseline.json --tolerance 0.25
+import argparse
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import chi_controller
+import chi_model
+from chi_data import SurveyData
+
+
+# Best time per call in seconds
+def best_time(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else float("nan")
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Write a synthetic survey (sample column plus categorical columns) and load it as a registered dataset
+def synthetic_dataset(directory, n_rows, n_columns, n_categories, seed=0):
+    rng = np.random.default_rng(seed)
+    frame = pd.DataFrame({"sample": rng.integers(1, 24, n_rows)})
+    for i in range(n_columns):
+        frame[f"var{i}"] = rng.choice([f"c{k}" for k in range(n_categories)], n_rows)
+    name = f"synthetic_{n_rows}_{n_columns}_{n_categories}"
+    path = os.path.join(directory, f"{name}.csv")
+    frame.to_csv(path, index=False)
+    start = time.perf_counter()
+    data = SurveyData.stream(path, name, os.path.join(directory, name))
+    ingest = time.perf_counter() - start
+    chi_model.chi_datasets[name] = data
+    return name, data, ingest
+
+
+# Layer 1 - model functions on synthetic datasets scaling rows, columns and categories per column
+def bench_model(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for n_rows, n_columns, n_categories in itertools.product(args.rows, args.columns, args.categories):
+            name, data, ingest = synthetic_dataset(directory, n_rows, n_columns, n_categories)
+            y, x = data.columns[1], data.columns[2]
+            key = f"model/{n_rows}x{n_columns}x{n_categories}"
+            results[f"{key}/ingest"] = ingest
+            # Pairs are only counted for columns with at most MAX_CATEGORIES categories - larger ones only measure ingest
+            if n_categories > chi_model.MAX_CATEGORIES:
+                print(f"{key}: more than {chi_model.MAX_CATEGORIES} categories, only ingest is measured", file=sys.stderr)
+                del chi_model.chi_datasets[name]
+                continue
+            results[f"{key}/compute_chi2_ind"] = best_time(lambda: chi_model.compute_chi2_ind(y, x, name), args.number)
+            results[f"{key}/calc_chi2_ind_cached"] = best_time(lambda: chi_model.calc_chi2_ind(y, x, name), args.number)
+            results[f"{key}/association"] = best_time(
+                lambda: chi_model.compute_association(data.columns[1:], name), max(1, args.number // 10))
+            del chi_model.chi_datasets[name]
+    results["model/create_blank_fig"] = best_time(chi_model.create_blank_fig, args.number)
+    return results
+
+
+# Layer 2 - every chi_controller callback called directly with the default dataset
+def bench_callbacks(args):
+    y, x = "Residence", "Extrovert_introvert"
+    p = chi_model.calc_chi2_ind(y, x)[7]
+    callbacks = {
+        "update_bar": lambda: chi_controller.update_bar(1, y, x, chi_model.DATASET),
+        "update_results": lambda: chi_controller.update_results(1, y, x),
+        "update_datatables": lambda: chi_controller.update_datatables(1, y, x, chi_model.DATASET),
+        "update_strata": lambda: chi_controller.update_strata(1, True, y, x, chi_model.DATASET),
+        "accept_or_reject95": lambda: chi_controller.accept_or_reject95("reject", p),
+        "accept_or_reject99": lambda: chi_controller.accept_or_reject99("accept", p),
+    }
+    results = {f"callbacks/{name}": best_time(func, args.number) for name, func in callbacks.items()}
+    results["callbacks/permutation_test_1000"] = best_time(
+        lambda: chi_model.permutation_test(y, x, iterations=1000, workers=1), 1)
+    return results
+
+
+# Build a _dash-update-component request body for a registered callback from current property values
+def dash_payload(dependency, values):
+    output = dependency["output"]
+    if output.startswith(".."):
+        outputs = [dict(zip(("id", "property"), o.rsplit(".", 1))) for o in output.strip(".").split("...")]
+    else:
+        outputs = dict(zip(("id", "property"), output.rsplit(".", 1)))
+    return {"output": output,
+            "outputs": outputs,
+            "inputs": [dict(i, value=values.get((i["id"], i["property"]))) for i in dependency["inputs"]],
+            "state": [dict(s, value=values.get((s["id"], s["property"]))) for s in dependency["state"]],
+            "changedPropIds": [f"{i['id']}.{i['property']}" for i in dependency["inputs"]]}
+
+
+# HTTP client for a running server with the same get/post interface used from Flask's test client
+class UrlClient:
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def get(self, path):
+        with urllib.request.urlopen(self.url + path) as response:
+            return json.load(response)
+
+    def post(self, path, json_body):
+        request = urllib.request.Request(self.url + path,
+                                         data=json.dumps(json_body).encode(),
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            return response.status
+
+
+# Layer 3 - simulated users each submitting variable pairs and answering the conclusion questions
+def bench_load(args):
+    if args.url:
+        new_client = lambda: UrlClient(args.url)
+        dependencies = new_client().get("/_dash-dependencies")
+        post = lambda client, body: client.post("/_dash-update-component", body)
+    else:
+        new_client = chi_controller.app.server.test_client
+        dependencies = new_client().get("/_dash-dependencies").json
+        post = lambda client, body: client.post("/_dash-update-component", json=body).status_code
+    by_trigger = {}
+    for dependency in dependencies:
+        if dependency.get("clientside_function") or dependency.get("long") or dependency.get("background"):
+            continue
+        by_trigger.setdefault(dependency["inputs"][0]["id"], []).append(dependency)
+    pairs = list(itertools.permutations(chi_model.selectable_columns(), 2))
+
+    def user(seed):
+        rng = np.random.default_rng(seed)
+        user_client = new_client()
+        latencies = []
+        for click in range(1, args.clicks + 1):
+            y, x = pairs[rng.integers(len(pairs))]
+            values = {("submit", "n_clicks"): click,
+                      ("dataset", "value"): chi_model.DATASET,
+                      ("dependent", "value"): y,
+                      ("independent", "value"): x,
+                      ("stratify", "value"): False,
+                      ("accept-reject95", "value"): "reject",
+                      ("accept-reject99", "value"): "accept",
+                      ("p-store", "data"): 0.03}
+            for trigger in ("submit", "accept-reject95", "accept-reject99"):
+                for dependency in by_trigger.get(trigger, []):
+                    start = time.perf_counter()
+                    status = post(user_client, dash_payload(dependency, values))
+                    latencies.append(time.perf_counter() - start)
+                    if status not in (200, 204):
+                        raise RuntimeError(f"{dependency['output']} returned {status}")
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.users) as pool:
+        latencies = list(itertools.chain.from_iterable(pool.map(user, range(args.users))))
+    elapsed = time.perf_counter() - start
+    return {"load/p50": percentile(latencies, 50),
+            "load/p95": percentile(latencies, 95),
+            "load/p99": percentile(latencies, 99),
+            "load/requests_per_second": len(latencies) / elapsed,
+            "load/peak_rss_mb": peak_rss_mb()}
+
+
+# Run in a new interpreter so nothing is already imported or cached in memory
+STARTUP_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import wsgi
+imported = time.perf_counter()
+client = wsgi.server.test_client()
+client.get("/")
+client.get("/_dash-layout")
+page = time.perf_counter()
+import chi_controller
+chi_controller.update_bar(1, "Residence", "Extrovert_introvert", "chi_happy")
+print(json.dumps({"import": imported - started,
+                  "first_page": page - imported,
+                  "first_submit": time.perf_counter() - page}))
+"""
+
+
+# Layer 4 - cold start of the production entry point, median of --starts new processes
+def bench_startup(args):
+    runs = [json.loads(subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=ROOT, check=True,
+                                      capture_output=True, text=True).stdout)
+            for _ in range(args.starts)]
+    return {f"startup/{name}": float(np.median([run[name] for run in runs])) for name in runs[0]}
+
+
+# Metrics where a larger value is better - everything else is a time or a size
+HIGHER_IS_BETTER = {"load/requests_per_second"}
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        change = (old - value) / old if name in HIGHER_IS_BETTER else (value - old) / old
+        flag = "REGRESSION" if change > tolerance else ""
+        print(f"{name:<55} {old:>12.6g} {value:>12.6g} {change:>+8.1%} {flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    ints = lambda text: [int(v) for v in text.split(",")]
+    parser = argparse.ArgumentParser(description="Benchmark the model, callbacks and app")
+    parser.add_argument("layers", nargs="*", help="model, callbacks, load and/or startup (default: all)")
+    parser.add_argument("--rows", type=ints, default=[1000, 100000])
+    parser.add_argument("--columns", type=ints, default=[6, 20])
+    parser.add_argument("--categories", type=ints, default=[2, 10])
+    parser.add_argument("--number", type=int, default=20, help="calls per timing")
+    parser.add_argument("--users", type=int, default=8, help="concurrent simulated users")
+    parser.add_argument("--clicks", type=int, default=20, help="submits per simulated user")
+    parser.add_argument("--starts", type=int, default=5, help="new processes started by the startup benchmark")
+    parser.add_argument("--url", help="run the load test against a running server instead of Flask's test client")
+    parser.add_argument("--save-baseline", help="write results to this JSON file")
+    parser.add_argument("--compare", help="compare results with a baseline JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before a regression is reported")
+    args = parser.parse_args()
+
+    benchmarks = {"model": bench_model, "callbacks": bench_callbacks, "load": bench_load, "startup": bench_startup}
+    unknown = set(args.layers) - set(benchmarks)
+    if unknown:
+        parser.error(f"unknown layers: {', '.join(sorted(unknown))}")
+    results = {}
+    for layer in args.layers or benchmarks:
+        results.update(benchmarks[layer](args))
+    results["peak_rss_mb"] = peak_rss_mb()
+    for name, value in results.items():
+        print(f"{name:<55} {value:>12.6g}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\n{'metric':<55} {'baseline':>12} {'current':>12} {'change':>8}")
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
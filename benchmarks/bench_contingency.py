@@ -0,0 +1,80 @@
+# Benchmark the single-pass bincount contingency engine against the previous four pd.crosstab implementation
+# Run from the repository root: python benchmarks/bench_contingency.py [--rows 1170,100000,1000000,10000000]
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import scipy.stats as stat
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chi_model import count_pair, contingency_tables
+
+
+# Previous implementation - filter dataframe and build four crosstabs with margins
+def crosstab_chi2_ind(df, y, x):
+    dff = df[[y, x]].dropna().reset_index(drop=True)
+    ct = pd.crosstab(index=dff[y], columns=dff[x],
+                     margins=True, margins_name="Expected")
+    ct_norm = pd.crosstab(index=dff[y], columns=dff[x], normalize="columns",
+                          margins=True, margins_name="Expected")
+    ct_t = pd.crosstab(index=dff[y], columns=dff[x], normalize="columns",
+                       margins=True, margins_name="Expected").transpose()
+    ct_table = pd.crosstab(index=dff[y], columns=dff[x],
+                           margins=True, margins_name="Expected").transpose()
+    dep_cat = dff[y].unique()
+    ind_cat = dff[x].unique()
+    chi2, p, dof, expected = stat.chi2_contingency(ct, correction=True)
+    return ct, ct_norm, ct_t, ct_table, dep_cat, ind_cat, chi2, p, dof, expected
+
+
+# Bincount engine on columns that were integer-encoded once up front
+def bincount_chi2_ind(codes, labels, y, x):
+    counts = count_pair(codes[y], codes[x], len(labels[y]), len(labels[x]))
+    return contingency_tables(counts, labels[y], labels[x], y, x)
+
+
+# Return best wall time (seconds) and peak traced allocation (bytes) of a function call
+def measure(func, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the contingency engine")
+    parser.add_argument("--rows", default="1170,100000,1000000,10000000",
+                        help="comma-separated row counts to benchmark")
+    parser.add_argument("--y", default="Residence")
+    parser.add_argument("--x", default="Extrovert_introvert")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    survey = pd.read_csv("data/chi_happy.csv")
+    rng = np.random.default_rng(0)
+    print(f"{'rows':>12} {'crosstab ms':>12} {'bincount ms':>12} {'speedup':>8} "
+          f"{'crosstab MB':>12} {'bincount MB':>12}")
+    for n_rows in [int(n) for n in args.rows.split(",")]:
+        # Resample survey rows (with replacement) to reach the requested size
+        df = survey.iloc[rng.integers(0, len(survey), n_rows)].reset_index(drop=True)
+        codes = {}
+        labels = {}
+        for col in (args.y, args.x):
+            codes[col], labels[col] = pd.factorize(df[col], sort=True)
+        old_time, old_peak = measure(lambda: crosstab_chi2_ind(df, args.y, args.x), args.repeats)
+        new_time, new_peak = measure(lambda: bincount_chi2_ind(codes, labels, args.y, args.x), args.repeats)
+        print(f"{n_rows:>12} {old_time * 1000:>12.2f} {new_time * 1000:>12.2f} "
+              f"{old_time / new_time:>7.1f}x {old_peak / 1e6:>12.1f} {new_peak / 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
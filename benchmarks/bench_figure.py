@@ -0,0 +1,70 @@
+# Benchmark the dict-based bar chart builder and cached figures against building a go.Figure for every request
+# Run from the repository root: python benchmarks/bench_figure.py [--number 200]
+import argparse
+import json
+import os
+import sys
+import timeit
+import plotly
+import plotly.graph_objects as go
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chi_model import calc_chi2_ind, calc_bar_fig, bar_figure, category_colours, DATASET
+
+
+# Previous implementation - Plotly graph objects validated at every step
+def go_figure(ct_t, dependent, independent, colours):
+    data = []
+    for x in ct_t.columns:
+        data.append(go.Bar(name=str(x),
+                           x=ct_t.index,
+                           y=ct_t[x],
+                           marker_color=colours[str(x)],
+                           marker_opacity=0.7,
+                           hovertemplate="Proportion: %{y:.2%}<extra></extra>"))
+    fig = go.Figure(data)
+    fig.update_layout(barmode="stack",
+                      margin=dict(t=20, b=10, l=20, r=20),
+                      height=400,
+                      font_size=14,
+                      dragmode=False,
+                      legend_title_text=dependent,
+                      legend_title_font_size=14,
+                      xaxis_type="category")
+    fig.update_xaxes(tick0=ct_t.index[0],
+                     dtick=1,
+                     title_text=independent)
+    fig.update_yaxes(title_text=f"Proportion ({dependent})",
+                     range=[0, 1])
+    return fig
+
+
+# Serialise as Dash does when sending a callback response
+def to_json(fig):
+    return json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bar chart construction")
+    parser.add_argument("--y", default="Residence")
+    parser.add_argument("--x", default="Extrovert_introvert")
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    ct_t = calc_chi2_ind(args.y, args.x)[2]
+    colours = category_colours(DATASET, args.y)
+    paths = {
+        "go.Figure": lambda: to_json(go_figure(ct_t, args.y, args.x, colours)),
+        "dict builder": lambda: to_json(bar_figure(ct_t, args.y, args.x, f"Proportion ({args.y})", colours)),
+        "cached figure": lambda: to_json(calc_bar_fig(args.y, args.x)),
+    }
+    baseline = None
+    print(f"{'path':<16} {'ms per figure':>14} {'speedup':>8}")
+    for name, build in paths.items():
+        seconds = min(timeit.repeat(build, number=args.number, repeat=3)) / args.number
+        baseline = baseline or seconds
+        print(f"{name:<16} {seconds * 1000:>14.3f} {baseline / seconds:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
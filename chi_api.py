@@ -0,0 +1,51 @@
+import json
+import os
+from flask import Response, jsonify, request, stream_with_context
+from chi_model import MAX_CATEGORIES, calc_chi2_batch, chi_datasets, default_dataset
+from chi_view import app
+
+# Largest request body (bytes) and number of pairs accepted by a single batch request
+API_MAX_BYTES = int(os.environ.get("CHI_API_MAX_BYTES", 1_000_000))
+API_MAX_PAIRS = int(os.environ.get("CHI_API_MAX_PAIRS", 10_000))
+
+# Pairs evaluated per pass when streaming - each pass is sent as soon as it is computed
+STREAM_BATCH = 500
+
+
+# Chi-squared results for many pairs in one request, for reporting jobs and other non-UI clients
+# Body: {"pairs": [{"dataset": "chi_happy", "dependent": "UK_citizen", "independent": "Sex"}, ...]} - dataset is optional
+# Responds with {"results": [...]} in request order, or with one result per line (NDJSON) for "Accept: application/x-ndjson"
+@app.server.route("/api/chi2", methods=["POST"])
+def chi2_batch():
+    if request.content_length is None:
+        return jsonify(error="Content-Length is required"), 411
+    if request.content_length > API_MAX_BYTES:
+        return jsonify(error=f"Request body must be at most {API_MAX_BYTES} bytes"), 413
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("pairs"), list):
+        return jsonify(error='Expected a JSON object with a list of "pairs"'), 400
+    if len(body["pairs"]) > API_MAX_PAIRS:
+        return jsonify(error=f"At most {API_MAX_PAIRS} pairs can be requested at once"), 413
+    pairs = []
+    default = default_dataset()
+    for pair in body["pairs"]:
+        if not isinstance(pair, dict):
+            return jsonify(error=f"Expected an object with dependent and independent, got {pair!r}"), 400
+        dataset = pair.get("dataset", default)
+        y, x = pair.get("dependent"), pair.get("independent")
+        if dataset not in chi_datasets:
+            return jsonify(error=f"Unknown dataset {dataset}"), 404
+        data = chi_datasets[dataset]
+        if y not in data.columns or x not in data.columns or y == x:
+            return jsonify(error=f"Dependent and independent must be different columns of {dataset}, got {y!r} and {x!r}"), 400
+        if not (data.paired(y) and data.paired(x)):
+            return jsonify(error=f"Columns with more than {MAX_CATEGORIES} categories cannot be tested, got {y!r} and {x!r}"), 400
+        pairs.append((dataset, y, x))
+
+    if request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson":
+        def generate():
+            for start in range(0, len(pairs), STREAM_BATCH):
+                for result in calc_chi2_batch(pairs[start:start + STREAM_BATCH]):
+                    yield json.dumps(result) + "\n"
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    return jsonify(results=calc_chi2_batch(pairs))
@@ -0,0 +1,14 @@
+# Build step for fast cold starts, run when the image is built (see Dockerfile): python chi_build.py
+# Streams each survey file under data/ into its persisted counts and writes the figures and client-side data for the initial page,
+# so a new container serves its first page without reading the CSV or computing any results
+import chi_model
+
+if __name__ == "__main__":
+    for dataset in chi_model.chi_datasets.names():
+        data = chi_model.chi_datasets[dataset]
+        try:
+            chi_model.initial_layout_data(dataset)
+        except ValueError as e:
+            print(f"{dataset}: {data.n_rows} rows, no initial layout - {e}")
+            continue
+        print(f"{dataset}: {data.n_rows} rows, initial layout written to {data.cache_dir}")
@@ -0,0 +1,99 @@
+from collections import OrderedDict
+import threading
+
+
+# Bounded, thread-safe LRU cache with hit/miss counters
+# Concurrent callers asking for the same key wait for a single computation rather than each computing it
+# Each worker process holds its own cache - results are deterministic, so processes never need to agree on contents
+# Room can be reserved on top of maxsize for results that must all stay cached, such as every pair of a dataset
+class ResultCache:
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._reserved = {}
+        self._results = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._results:
+                self.hits += 1
+                self._results.move_to_end(key)
+                return self._results[key]
+            self.misses += 1
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            pending.wait()
+            with self._lock:
+                if key in self._results:
+                    return self._results[key]
+            # Computation failed in the owning thread - compute here instead
+            return compute()
+        try:
+            result = compute()
+            self.put(key, result)
+            return result
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.set()
+
+    # Cached result for key, or None - for callers that compute missing results together (see chi_model.calc_chi2_batch)
+    def get(self, key):
+        with self._lock:
+            if key in self._results:
+                self.hits += 1
+                self._results.move_to_end(key)
+                return self._results[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, result):
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            self._trim()
+
+    # Keep room for n more entries on behalf of owner, replacing any earlier reservation it made
+    def reserve(self, owner, n):
+        with self._lock:
+            self._reserved[owner] = n
+            self._trim()
+
+    def release(self, owner):
+        with self._lock:
+            self._reserved.pop(owner, None)
+            self._trim()
+
+    # Entries held before the least recently used are evicted - called with the lock held
+    def _capacity(self):
+        return self.maxsize + sum(self._reserved.values())
+
+    def _trim(self):
+        while len(self._results) > self._capacity():
+            self._results.popitem(last=False)
+
+    # Remove every result whose key matches predicate(key)
+    def discard(self, predicate):
+        with self._lock:
+            for key in [key for key in self._results if predicate(key)]:
+                del self._results[key]
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def info(self):
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self._results),
+                    "maxsize": self.maxsize,
+                    "capacity": self._capacity()}
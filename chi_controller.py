@@ -1,12 +1,46 @@
-from dash import html, Input, Output, State, exceptions, no_update, dash_table
-import pandas as pd
-import plotly.graph_objects as go
-from chi_model import calc_chi2_ind, stat_colours
-from chi_view import app
+from dash import html, Input, Output, State, ClientsideFunction, exceptions, no_update, dash_table
+import numpy as np
+from chi_model import calc_chi2_ind, calc_bar_fig, calc_strata, permutation_test, pc_column_labels, chi_datasets, STRATUM
+from chi_metrics import instrumented
+# celery_app is imported so Celery workers started with -A chi_controller.celery_app register every callback
+from chi_view import app, celery_app, CLIENTSIDE, dataset_content
+# Registers the /api, /ingest, /healthz and /readyz routes on app.server
+import chi_api
+import chi_health
+import chi_ingest
 
 
-# Callback function to update bar chart, screen reader text and results based on user selection of dependent/independent variable
+# Register a callback on the server, or in client-side mode as the function of the same name in assets/chi_clientside.js
+# Clientside functions receive the precomputed results in pair-store as an extra final argument
+def chi_callback(*args, **kwargs):
+    def register(func):
+        if CLIENTSIDE:
+            app.clientside_callback(ClientsideFunction(namespace="chi", function_name=func.__name__),
+                                    *args,
+                                    State("pair-store", "data"),
+                                    **kwargs)
+            return func
+        return app.callback(*args, **kwargs)(instrumented(func))
+    return register
+
+
+# Callback function to show the variables, results and figures of the selected dataset - loaded the first time it is selected
+# Always evaluated on the server, which holds the data
 @app.callback(
+    Output("dataset-content", "children"),
+    Input("dataset", "value"),
+    prevent_initial_call=True
+)
+@instrumented
+def select_dataset(dataset):
+    if dataset not in chi_datasets:
+        raise exceptions.PreventUpdate
+    else:
+        return dataset_content(dataset)
+
+
+# Callback function to update bar chart, screen reader text and results based on user selection of dependent/independent variable
+@chi_callback(
     Output("graph", "figure"),
     Output("sr-bar", "children"),
     Output("p-value", "children"),
@@ -18,46 +52,26 @@ from chi_view import app
     Input("submit", "n_clicks"),
     State("dependent", "value"),
     State("independent", "value"),
+    State("dataset", "value"),
     prevent_initial_call=True
 )
-def update_bar(n_clicks, dependent, independent):
-    if n_clicks is None:
+def update_bar(n_clicks, dependent, independent, dataset):
+    if n_clicks is None or dataset not in chi_datasets:
         raise exceptions.PreventUpdate
     else:
         if dependent == independent:
             return no_update, no_update, no_update, no_update, no_update, True
         else:
-            _, _, ct_t, _, _, _, _, p, _, _ = calc_chi2_ind(
-                dependent, independent)
-            data = []
-            for x in ct_t.columns:
-                data.append(go.Bar(name=str(x),
-                                   x=ct_t.index,
-                                   y=ct_t[x],
-                                   marker_color=stat_colours[str(x)],
-                                   marker_opacity=0.7,
-                                   hovertemplate="Proportion: %{y:.2%}<extra></extra>"))
-            fig = go.Figure(data)
-            fig.update_layout(barmode="stack",
-                              margin=dict(t=20, b=10, l=20, r=20),
-                              height=400,
-                              font_size=14,
-                              dragmode=False,
-                              legend_title_text=dependent,
-                              legend_title_font_size=14,
-                              xaxis_type="category")
-            fig.update_xaxes(tick0=ct_t.index[0],
-                             dtick=1,
-                             title_text=independent)
-            fig.update_yaxes(title_text=f"Proportion ({dependent})",
-                             range=[0,1])
+            _, _, _, _, _, _, _, p, _, _ = calc_chi2_ind(
+                dependent, independent, dataset)
+            fig = calc_bar_fig(dependent, independent, dataset)
             # Screen reader text
             sr_text = f"Bar chart of dependent variable {dependent} for independent variable {independent}"
         return fig, sr_text, f"{p:.3f}", p, {"display": "inline"}, False
 
 
 # Callback function to generate natural language versions of null/alternative hypothesis and reset Conclusion section
-@app.callback(
+@chi_callback(
     Output("null-hyp", "children"),
     Output("alt-hyp", "children"),
     # Reset Conclusion section whenever callback triggered
@@ -82,101 +96,132 @@ def update_results(n_clicks, dependent, independent):
             return null_hyp, alt_hyp, None, None, False, False
 
 
-# Callback function to populate and format DataTables
-@app.callback(
-    Output("table-observed", "children"),
-    Output("table-expected", "children"),
-    Output("table-observed-pc", "children"),
+# Callback function to populate DataTables - the tables and their formatting are in the layout, so only rows and columns are sent
+@chi_callback(
+    Output("table-observed", "data"),
+    Output("table-observed", "columns"),
+    Output("table-expected", "data"),
+    Output("table-expected", "columns"),
+    Output("table-observed-pc", "data"),
+    Output("table-observed-pc", "columns"),
     Input("submit", "n_clicks"),
     State("dependent", "value"),
     State("independent", "value"),
+    State("dataset", "value"),
     prevent_initial_call=True
 )
-def update_datatables(n_clicks, dependent, independent):
-    if n_clicks is None:
+def update_datatables(n_clicks, dependent, independent, dataset):
+    if n_clicks is None or dataset not in chi_datasets:
         raise exceptions.PreventUpdate
     else:
         if dependent == independent:
-            return no_update, no_update, no_update
+            return no_update, no_update, no_update, no_update, no_update, no_update
         else:
-            ct, ct_norm, _, ct_table, _, _, _, _, _, expected = calc_chi2_ind(
-                dependent, independent)
-
-            obs_df = ct.iloc[:-1, :].copy()
-            obs_df.rename(columns={"Expected": "Total"},
-                        inplace=True)
-            obs_df.sort_index(ascending=False, inplace=True)
-
-            exp_df = pd.DataFrame(data=expected,
-                                  index=ct_table.columns,
-                                  columns=ct_table.index).round(2).iloc[:-1, :]
-            exp_df.rename(columns={"Expected": "Total"},
-                          inplace=True)
-            exp_df.sort_index(ascending=False, inplace=True)
-
-            obs_pc_df = ct_norm
-            obs_pc_df.rename(columns={"UK": "UK (obs)",
-                                      "EU": "EU (obs)",
-                                      "International": "Int'l (obs)",
-                                      "Y": "Y (obs)",
-                                      "N": "N (obs)",
-                                      "F": "F (obs)",
-                                      "M": "M (obs)",
-                                      "Extrovert": "Extrovert (obs)",
-                                      "Introvert": "Introvert (obs)",
-                                      "Expected": "Expected"},
-                             inplace=True)
-            obs_pc_df.sort_index(ascending=False, inplace=True)
+            ct, ct_norm, _, _, dep_cat, ind_cat, _, _, _, expected = calc_chi2_ind(
+                dependent, independent, dataset)
+
+            # Rows in descending order of the dependent variable's categories, which come sorted
+            order = np.arange(len(dep_cat))[::-1]
+            names = [*ind_cat, "Total"]
+            labels = pc_column_labels(dataset)
+            pc_names = [labels.get(c, c) for c in ct_norm.columns]
+
+            obs_data = [dict(zip(names, row)) for row in ct.values[order].tolist()]
+            exp_data = [dict(zip(names, row)) for row in np.round(expected, 2)[order].tolist()]
+            obs_pc_data = [dict(zip(pc_names, row)) for row in ct_norm.values[order].tolist()]
 
             formatted = {'locale': {},
-                        'nully': '',
-                        'prefix': None,
-                        'specifier': '.2%'}
-
-            table_obs = dash_table.DataTable(data=obs_df.to_dict("records"),
-                                             columns=[{"name": i,
-                                                       "id": i}
-                                                      for i in obs_df.columns],
-                                             style_header={"fontWeight": "bold"},
-                                             style_table={"width": "70%"},
-                                             style_cell={"minWidth": "120px",
-                                                         "width": "120px",
-                                                         "maxWidth": "120px",
-                                                         "font-family": "Regular"},
-                                             fill_width=False,
-                                             cell_selectable=False)
-            table_exp = dash_table.DataTable(data=exp_df.to_dict("records"),
-                                             columns=[{"name": i,
-                                                       "id": i}
-                                                      for i in exp_df.columns],
-                                             style_header={
-                                                "fontWeight": "bold"},
-                                             style_table={"width": "70%"},
-                                             style_cell={"minWidth": "120px",
-                                                         "width": "120px",
-                                                         "maxWidth": "120px",
-                                                         "font-family": "Regular"},
+                         'nully': '',
+                         'prefix': None,
+                         'specifier': '.2%'}
+            columns = [{"name": i, "id": i} for i in names]
+            pc_columns = [{"name": i, "id": i, "type": "numeric", "format": formatted} for i in pc_names]
+            return obs_data, columns, exp_data, columns, obs_pc_data, pc_columns
+
+
+# Callback function to show Chi-squared results for each sample alongside the pooled Cochran-Mantel-Haenszel test
+# Always evaluated on the server - per-sample results are not included in the client-side data
+@app.callback(
+    Output("table-strata", "children"),
+    Output("cmh-result", "children"),
+    Input("submit", "n_clicks"),
+    Input("stratify", "value"),
+    State("dependent", "value"),
+    State("independent", "value"),
+    State("dataset", "value"),
+    prevent_initial_call=True
+)
+@instrumented
+def update_strata(n_clicks, stratify, dependent, independent, dataset):
+    if not n_clicks or dependent == independent or dataset not in chi_datasets:
+        raise exceptions.PreventUpdate
+    elif not stratify or STRATUM not in chi_datasets[dataset].columns:
+        return [], ""
+    else:
+        strata, (cmh, cmh_dof, cmh_p) = calc_strata(dependent, independent, dataset)
+        strata_df = strata.reset_index()
+        formatted = {'locale': {},
+                     'nully': '',
+                     'prefix': None,
+                     'specifier': '.3f'}
+        table_strata = dash_table.DataTable(data=strata_df.to_dict("records"),
+                                            columns=[{"name": "Sample", "id": strata.index.name},
+                                                     {"name": "n", "id": "n"},
+                                                     {"name": "Chi-squared", "id": "chi2", "type": "numeric", "format": formatted},
+                                                     {"name": "df", "id": "dof"},
+                                                     {"name": "P value", "id": "p", "type": "numeric", "format": formatted}],
+                                            style_header={"fontWeight": "bold"},
+                                            style_table={"width": "70%",
+                                                         "maxHeight": "400px",
+                                                         "overflowY": "auto"},
+                                            style_cell={"minWidth": "120px",
+                                                        "width": "120px",
+                                                        "maxWidth": "120px",
+                                                        "font-family": "Regular"},
+                                            fixed_rows={"headers": True},
                                             fill_width=False,
                                             cell_selectable=False)
-            table_obs_pc = dash_table.DataTable(data=obs_pc_df.to_dict("records"),
-                                                columns=[{"name": i,
-                                                        "id": i,
-                                                        "type": "numeric",
-                                                        "format": formatted}
-                                                        for i in obs_pc_df.columns],
-                                                style_header={"fontWeight": "bold"},
-                                                style_table={"width": "70%"},
-                                                style_cell={"minWidth": "120px",
-                                                            "width": "120px",
-                                                            "maxWidth": "120px",
-                                                            "font-family": "Regular"},
-                                                fill_width=False,
-                                                cell_selectable=False)
-            return table_obs, table_exp, table_obs_pc
+        cmh_text = [html.Span("Pooled (Cochran-Mantel-Haenszel): ", className="bold-p"),
+                    html.Span(f"Chi-squared {cmh:.3f}, df {cmh_dof}, p value {cmh_p:.3f}")]
+        return table_strata, cmh_text
 
 
-# Callback function to give feedback when user decides whether to accept/reject the null hypothesis based on the calculated p-value (95% confidence)
+# Largest number of permutations a user can request
+MAX_PERMUTATIONS = 1000000
+
+
+# Background callback function to run a permutation test for the selected variables, reporting progress and allowing cancellation
 @app.callback(
+    Output("permutation-p", "children"),
+    Input("permutation-run", "n_clicks"),
+    State("dependent", "value"),
+    State("independent", "value"),
+    State("permutations", "value"),
+    State("seed", "value"),
+    State("dataset", "value"),
+    background=True,
+    running=[(Output("permutation-run", "disabled"), True, False),
+             (Output("permutation-cancel", "disabled"), False, True)],
+    cancel=[Input("permutation-cancel", "n_clicks")],
+    progress=[Output("permutation-progress", "value"),
+              Output("permutation-progress", "max")],
+    prevent_initial_call=True
+)
+def update_permutation(set_progress, n_clicks, dependent, independent, iterations, seed, dataset):
+    if n_clicks is None or dependent == independent or not iterations or dataset not in chi_datasets:
+        raise exceptions.PreventUpdate
+    else:
+        iterations = min(max(int(iterations), 1), MAX_PERMUTATIONS)
+        _, p = permutation_test(dependent, independent,
+                                iterations=iterations,
+                                seed=int(seed or 0),
+                                dataset=dataset,
+                                progress=lambda done, total: set_progress((done, total)))
+        return f"{p:.4f} ({dependent} by {independent}, {iterations} permutations)"
+
+
+# Callback function to give feedback when user decides whether to accept/reject the null hypothesis based on the calculated p-value (95% confidence)
+@chi_callback(
     Output("conclusion95", "children"),
     Input("accept-reject95", "value"),
     State("p-store", "data"),
@@ -208,7 +253,7 @@ def accept_or_reject95(accept_reject, p):
 
 
 # Callback function to give feedback when user decides whether to accept/reject the null hypothesis based on the calculated p-value (99% confidence)
-@app.callback(
+@chi_callback(
     Output("conclusion99", "children"),
     Input("accept-reject99", "value"),
     State("p-store", "data"),
@@ -240,6 +285,5 @@ def accept_or_reject99(accept_reject, p):
 
 
 if __name__ == "__main__":
+    # Development server - in production the app is served by gunicorn (see gunicorn.conf.py and wsgi.py)
     app.run(debug=True)
-    # To deploy on Docker, replace app.run(debug=True) with the following:
-    # app.run(debug=False, host="0.0.0.0", port=8080, dev_tools_ui=False)
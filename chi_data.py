@@ -0,0 +1,498 @@
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
+import io
+import json
+import os
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows - file locking between worker processes is skipped
+    fcntl = None
+
+# Number of CSV rows parsed at a time when streaming a survey file
+CHUNKSIZE = int(os.environ.get("CHI_CHUNKSIZE", 500_000))
+
+# Survey files (*.csv) are discovered in DATA_DIR - persisted counts and encoded columns are kept next to them
+DATA_DIR = "data"
+CACHE_DIR = os.path.join(DATA_DIR, ".cache")
+
+# Largest number of categories an int8- or int16-encoded column can hold (-1 is reserved for missing values) - wider columns use int32
+INT8_CATEGORIES = 127
+INT16_CATEGORIES = 32767
+
+# Pairwise counts are only kept for columns with at most this many categories - IDs and free text would need counts growing with rows x rows
+# Columns over the limit are still encoded, but cannot be used as variables
+MAX_CATEGORIES = 30
+
+
+# Sort category labels, numerically where every label is a number
+def sort_labels(labels):
+    try:
+        return sorted(labels, key=float)
+    except ValueError:
+        return sorted(labels)
+
+
+# Largest number of rows counted at once - bounds temporary arrays when counting memory-mapped columns, whatever the number of rows
+COUNT_CHUNK_ROWS = 10_000_000
+
+
+# Count observations for a pair of integer-encoded columns - rows with a missing value in either column are skipped
+def count_pair(y_codes, x_codes, n_y, n_x):
+    counts = np.zeros(n_y * n_x, dtype=np.int64)
+    for start in range(0, len(y_codes), COUNT_CHUNK_ROWS):
+        y_chunk = y_codes[start:start + COUNT_CHUNK_ROWS]
+        x_chunk = x_codes[start:start + COUNT_CHUNK_ROWS]
+        has_values = (y_chunk >= 0) & (x_chunk >= 0)
+        combined = y_chunk[has_values].astype(np.int64) * n_x + x_chunk[has_values]
+        counts += np.bincount(combined, minlength=n_y * n_x)
+    return counts.reshape(n_y, n_x)
+
+
+# Pairwise category counts for a survey file, accumulated chunk by chunk so memory depends on the number of categories rather than rows
+# Categories are coded in the order they are first seen, so codes already written never change as data is added
+# Each column is also kept as a compact integer-encoded file that can be memory-mapped for row-level analysis
+# Survey files are treated as append-only: rows added to the end of the CSV are applied as deltas without rescanning
+class SurveyData:
+    def __init__(self, name, columns, cache_dir, path=None):
+        self.name = name
+        self.columns = list(columns)
+        self.cache_dir = cache_dir
+        self.path = path
+        self.version = 0
+        self.lock = threading.RLock()
+        self.lock_depth = 0
+        self.last_sync = time.monotonic()
+        self.categories = [[] for _ in self.columns]
+        self.lookups = [{} for _ in self.columns]
+        self.dtypes = [np.dtype(np.int8) for _ in self.columns]
+        # Encoded column files are named by generation and dtype (see _codes_path) - a new generation starts each time the CSV is streamed
+        self.generation = None
+        self.counts = {}
+        self.n_rows = 0
+        self.source = None
+
+    # Load counts persisted by an earlier run, applying any rows appended to the CSV since, otherwise stream the CSV
+    @classmethod
+    def load(cls, path, name=None, cache_dir=None, chunksize=CHUNKSIZE):
+        name = name or os.path.splitext(os.path.basename(path))[0]
+        cache_dir = cache_dir or os.path.join(CACHE_DIR, name)
+        os.makedirs(cache_dir, exist_ok=True)
+        data = cls(name, [], cache_dir, path)
+        with data._locked():
+            saved = cls._load_cache(name, cache_dir, path)
+            if saved is not None and saved._appended_only():
+                saved._read_tail(chunksize)
+                return saved
+            data._stream(chunksize)
+        return data
+
+    # Read the whole CSV, replacing any persisted counts and encoded columns
+    @classmethod
+    def stream(cls, path, name, cache_dir, chunksize=CHUNKSIZE):
+        os.makedirs(cache_dir, exist_ok=True)
+        data = cls(name, [], cache_dir, path)
+        with data._locked():
+            data._stream(chunksize)
+        return data
+
+    # Pick up changes to the CSV made by another process - at most once per interval (seconds)
+    def sync(self, interval=0):
+        if time.monotonic() - self.last_sync < interval:
+            return False
+        with self._locked():
+            self.last_sync = time.monotonic()
+            if self._source_stamp(self.path) == self.source:
+                return False
+            saved = self._load_cache(self.name, self.cache_dir, self.path)
+            if saved is not None and saved.source != self.source and saved._appended_only():
+                # Another process has already applied (some of) the new rows, or read the changed file again
+                self._adopt(saved)
+                self._read_tail()
+            elif self._appended_only():
+                self._read_tail()
+            else:
+                self._stream()
+            return True
+
+    # Append rows from CSV text (with a header row) to the survey file and apply them to the counts
+    def append_csv(self, text):
+        frame = pd.read_csv(io.BytesIO(text), dtype=str)
+        if list(frame.columns) != self.columns:
+            raise ValueError(f"Expected columns {self.columns}, got {list(frame.columns)}")
+        with self._locked():
+            self.sync()
+            rows = frame.to_csv(header=False, index=False).encode()
+            with open(self.path, "ab") as f:
+                f.write(rows)
+            self.append(frame)
+            self.source = {"size": self.source["size"] + len(rows),
+                           "mtime_ns": os.stat(self.path).st_mtime_ns}
+            self.save()
+        return len(frame)
+
+    # Encode new rows, add their pairwise counts and append them to the encoded column files
+    def append(self, frame):
+        with self.lock:
+            codes = [self._encode(i, frame[col]) for i, col in enumerate(self.columns)]
+            self._drop_unpaired()
+            paired = [i for i in range(len(self.columns)) if self._paired(i)]
+            for k, i in enumerate(paired):
+                for j in paired[k + 1:]:
+                    shape = (len(self.categories[i]), len(self.categories[j]))
+                    counts = self._grow(self.counts.get((i, j)), shape)
+                    self.counts[(i, j)] = counts + count_pair(codes[i], codes[j], *shape)
+            for i, column_codes in enumerate(codes):
+                with open(self._codes_path(i), "ab") as f:
+                    f.write(column_codes.astype(self.dtypes[i]).tobytes())
+            self.n_rows += len(frame)
+            self.version += 1
+
+    # Counts for a (dependent, independent) pair with categories in sorted order (numeric where every label is a number)
+    def pair_counts(self, y, x):
+        i = self.columns.index(y)
+        j = self.columns.index(x)
+        with self.lock:
+            if not (self._paired(i) and self._paired(j)):
+                raise ValueError(f"No counts are kept for columns with more than {MAX_CATEGORIES} categories")
+            if i < j:
+                counts = self._grow(self.counts.get((i, j)), (len(self.categories[i]), len(self.categories[j])))
+            else:
+                counts = self._grow(self.counts.get((j, i)), (len(self.categories[j]), len(self.categories[i]))).T
+            y_order = [self.lookups[i][label] for label in sort_labels(self.categories[i])]
+            x_order = [self.lookups[j][label] for label in sort_labels(self.categories[j])]
+            return (counts[y_order][:, x_order],
+                    [self.categories[i][k] for k in y_order],
+                    [self.categories[j][k] for k in x_order])
+
+    # Encoded column file and dtype, for worker processes that memory-map it themselves
+    def codes_file(self, col):
+        i = self.columns.index(col)
+        return self._codes_path(i), self.dtypes[i].name
+
+    def n_categories(self, col):
+        return len(self.categories[self.columns.index(col)])
+
+    # True if pairwise counts are kept for a column (it has at most MAX_CATEGORIES categories)
+    def paired(self, col):
+        return self._paired(self.columns.index(col))
+
+    # Memory-mapped integer codes for one column (-1 marks a missing value)
+    def codes(self, col):
+        i = self.columns.index(col)
+        if self.n_rows == 0:
+            return np.empty(0, dtype=self.dtypes[i])
+        return np.memmap(self._codes_path(i), dtype=self.dtypes[i], mode="r", shape=(self.n_rows,))
+
+    # Approximate memory held by the counts and category lookups - encoded columns are memory-mapped on demand and not included
+    @property
+    def nbytes(self):
+        labels = sum(sys.getsizeof(label) for labels in self.categories for label in labels)
+        return sum(counts.nbytes for counts in self.counts.values()) + 2 * labels
+
+    def save(self):
+        np.savez(os.path.join(self.cache_dir, "counts.npz"),
+                 **{f"{i}_{j}": counts for (i, j), counts in self.counts.items()})
+        meta = {"name": self.name,
+                "columns": self.columns,
+                "categories": self.categories,
+                "dtypes": [dtype.name for dtype in self.dtypes],
+                "generation": self.generation,
+                "n_rows": self.n_rows,
+                "source": self.source}
+        # Write metadata last so an interrupted save is never mistaken for a complete one
+        with open(os.path.join(self.cache_dir, "meta.json.tmp"), "w") as f:
+            json.dump(meta, f)
+        os.replace(os.path.join(self.cache_dir, "meta.json.tmp"), os.path.join(self.cache_dir, "meta.json"))
+
+    @classmethod
+    def _load_cache(cls, name, cache_dir, path):
+        try:
+            with open(os.path.join(cache_dir, "meta.json")) as f:
+                meta = json.load(f)
+            generation = meta["generation"]
+            with np.load(os.path.join(cache_dir, "counts.npz")) as saved:
+                counts = {tuple(int(i) for i in key.split("_")): saved[key] for key in saved.files}
+        except (OSError, ValueError, KeyError):
+            return None
+        data = cls(name, meta["columns"], cache_dir, path)
+        data.categories = meta["categories"]
+        data.lookups = [{label: code for code, label in enumerate(labels)} for labels in data.categories]
+        data.dtypes = [np.dtype(dtype) for dtype in meta["dtypes"]]
+        data.generation = generation
+        data.counts = counts
+        data.n_rows = meta["n_rows"]
+        data.source = meta["source"]
+        data._drop_unpaired()
+        return data
+
+    # True if the CSV has only grown since it was last read
+    def _appended_only(self):
+        stamp = self._source_stamp(self.path)
+        if stamp == self.source:
+            return True
+        return stamp["size"] > self.source["size"] and stamp["mtime_ns"] >= self.source["mtime_ns"]
+
+    # Apply complete rows added to the end of the CSV since it was last read
+    def _read_tail(self, chunksize=CHUNKSIZE):
+        if self._source_stamp(self.path) == self.source:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.source["size"])
+            tail = f.read()
+        end = tail.rfind(b"\n") + 1
+        if end > 0:
+            for chunk in pd.read_csv(io.BytesIO(tail[:end]), header=None, names=self.columns,
+                                     dtype=str, chunksize=chunksize):
+                self.append(chunk)
+        self.source = {"size": self.source["size"] + end,
+                       "mtime_ns": os.stat(self.path).st_mtime_ns}
+        self.save()
+
+    def _stream(self, chunksize=CHUNKSIZE):
+        with self.lock:
+            self.columns = list(pd.read_csv(self.path, nrows=0).columns)
+            self.categories = [[] for _ in self.columns]
+            self.lookups = [{} for _ in self.columns]
+            self.dtypes = [np.dtype(np.int8) for _ in self.columns]
+            # New files rather than truncating the old ones, which other threads and processes may still have memory-mapped
+            previous = self.generation
+            self.generation = f"{time.time_ns():x}"
+            self.counts = {}
+            self.n_rows = 0
+            for i in range(len(self.columns)):
+                open(self._codes_path(i), "wb").close()
+            for chunk in pd.read_csv(self.path, chunksize=chunksize, dtype=str):
+                self.append(chunk)
+            self.source = self._source_stamp(self.path)
+            self.save()
+            self._remove_old_codes(keep=previous)
+
+    def _adopt(self, other):
+        with self.lock:
+            self.columns = other.columns
+            self.categories = other.categories
+            self.lookups = other.lookups
+            self.dtypes = other.dtypes
+            self.generation = other.generation
+            self.counts = other.counts
+            self.n_rows = other.n_rows
+            self.source = other.source
+            self.version += 1
+
+    # Serialise changes between threads and between worker processes sharing the cache directory
+    @contextmanager
+    def _locked(self):
+        with self.lock:
+            if self.lock_depth:
+                # This thread already holds the file lock
+                self.lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth -= 1
+                return
+            with open(os.path.join(self.cache_dir, ".lock"), "w") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                self.lock_depth = 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth = 0
+
+    @staticmethod
+    def _source_stamp(path):
+        stat = os.stat(path)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def _paired(self, i):
+        return len(self.categories[i]) <= MAX_CATEGORIES
+
+    # Categories are never removed, so once a column passes MAX_CATEGORIES its counts are no longer needed
+    def _drop_unpaired(self):
+        for i, j in list(self.counts):
+            if not (self._paired(i) and self._paired(j)):
+                del self.counts[(i, j)]
+
+    @staticmethod
+    def _grow(counts, shape):
+        if counts is None:
+            return np.zeros(shape, dtype=np.int64)
+        if counts.shape == shape:
+            return counts
+        return np.pad(counts, [(0, shape[0] - counts.shape[0]), (0, shape[1] - counts.shape[1])])
+
+    # Files are never rewritten in place: existing memory maps keep reading the file they opened, and a process holding
+    # out-of-date metadata opens the file matching its own dtype and row count rather than misreading a rewritten one
+    def _codes_path(self, i):
+        return os.path.join(self.cache_dir, f"col_{i}.{self.generation}.{self.dtypes[i].name}.bin")
+
+    # Remove encoded column files of older generations - the previous generation is kept for processes that have not synced yet,
+    # and files that are still mapped stay readable until unmapped
+    def _remove_old_codes(self, keep=None):
+        current = {os.path.basename(self._codes_path(i)) for i in range(len(self.columns))}
+        for entry in os.scandir(self.cache_dir):
+            if (entry.name.startswith("col_") and entry.name.endswith(".bin") and entry.name not in current
+                    and (keep is None or entry.name.split(".")[1] != keep)):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    # Map a chunk of labels to stable codes, adding categories not seen before
+    def _encode(self, i, values):
+        local_codes, uniques = pd.factorize(values)
+        lookup = self.lookups[i]
+        for label in uniques:
+            if label not in lookup:
+                lookup[label] = len(self.categories[i])
+                self.categories[i].append(label)
+        if len(self.categories[i]) > INT16_CATEGORIES and self.dtypes[i].itemsize < 4:
+            self._widen(i, np.int32)
+        elif len(self.categories[i]) > INT8_CATEGORIES and self.dtypes[i].itemsize < 2:
+            self._widen(i, np.int16)
+        remap = np.array([lookup[label] for label in uniques] + [-1], dtype=np.int64)
+        return remap[local_codes]
+
+    # Copy an encoded column to a file with a wider integer type once it has too many categories for its current one
+    # The narrower file is left for readers still using it and removed the next time the CSV is streamed
+    def _widen(self, i, dtype):
+        widened = np.fromfile(self._codes_path(i), dtype=self.dtypes[i]).astype(dtype)
+        self.dtypes[i] = np.dtype(dtype)
+        path = self._codes_path(i)
+        widened.tofile(f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+
+
+# Counts for a batch of random permutations of x against y, as a (size, n_y, n_x) array
+# Rows with a missing value in either column must already have been removed
+# Small inputs are shuffled and counted as one array; batches of more than COUNT_CHUNK_ROWS values are shuffled
+# one permutation at a time and counted in row chunks, so only a copy of x (in its own dtype) grows with the number of rows
+def count_permuted(y_codes, x_codes, n_y, n_x, seed, size):
+    rng = np.random.default_rng(seed)
+    if size * len(x_codes) <= COUNT_CHUNK_ROWS:
+        shuffled = rng.permuted(np.broadcast_to(x_codes, (size, len(x_codes))), axis=1)
+        combined = (np.arange(size, dtype=np.int64)[:, None] * (n_y * n_x)
+                    + y_codes.astype(np.int64) * n_x + shuffled)
+        return np.bincount(combined.ravel(), minlength=size * n_y * n_x).reshape(size, n_y, n_x)
+    return np.stack([count_pair(y_codes, rng.permutation(x_codes), n_y, n_x) for _ in range(size)])
+
+
+# Permutation batch for two encoded column files, run in worker processes
+# Workers memory-map the files themselves, so only the file names and a seed are sent to each worker
+# Rows with values in both columns (n_values of them) are copied a chunk at a time, without temporaries spanning every row
+def count_permuted_files(y_file, x_file, n_rows, n_values, n_y, n_x, seed, size):
+    y_codes = np.memmap(y_file[0], dtype=y_file[1], mode="r", shape=(n_rows,))
+    x_codes = np.memmap(x_file[0], dtype=x_file[1], mode="r", shape=(n_rows,))
+    y_values = np.empty(n_values, dtype=y_codes.dtype)
+    x_values = np.empty(n_values, dtype=x_codes.dtype)
+    filled = 0
+    for start in range(0, n_rows, COUNT_CHUNK_ROWS):
+        y_chunk = y_codes[start:start + COUNT_CHUNK_ROWS]
+        x_chunk = x_codes[start:start + COUNT_CHUNK_ROWS]
+        has_values = (y_chunk >= 0) & (x_chunk >= 0)
+        n = int(has_values.sum())
+        y_values[filled:filled + n] = y_chunk[has_values]
+        x_values[filled:filled + n] = x_chunk[has_values]
+        filled += n
+    return count_permuted(y_values, x_values, n_y, n_x, seed, size)
+
+
+# Survey datasets by name, discovered as data/<name>.csv and loaded the first time each is used
+# Loaded datasets are kept in least recently used order and evicted once together they hold more than max_bytes
+# (the dataset just loaded is always kept) - on_evict(name) is called so results derived from an evicted dataset can be dropped
+class DatasetRegistry(Mapping):
+    def __init__(self, data_dir=DATA_DIR, max_bytes=None, on_evict=None):
+        self.data_dir = data_dir
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.evictions = 0
+        self._loaded = OrderedDict()
+        self._registered = {}
+        self._loading = {}
+        # Versions continue from those of an evicted copy, so results cached under an old version are never mistaken for new ones
+        self._next_version = {}
+        self._lock = threading.Lock()
+
+    # Names of every available dataset, loaded or not - the data directory is rescanned so new files are picked up
+    def names(self):
+        try:
+            found = [entry.name[:-4] for entry in os.scandir(self.data_dir)
+                     if entry.is_file() and entry.name.endswith(".csv")]
+        except FileNotFoundError:
+            found = []
+        return sorted(set(found) | set(self._registered))
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name in self._registered:
+                return self._registered[name]
+            if name in self._loaded:
+                self._loaded.move_to_end(name)
+                return self._loaded[name]
+        # Names come from clients, so only files found in the data directory are ever opened - never a path
+        if name not in self.names():
+            raise KeyError(name)
+        with self._lock:
+            loading = self._loading.setdefault(name, threading.Lock())
+        # Datasets load one at a time per name, without holding up requests for other datasets
+        with loading:
+            with self._lock:
+                if name in self._loaded:
+                    return self._loaded[name]
+            data = SurveyData.load(os.path.join(self.data_dir, f"{name}.csv"), name=name)
+            with self._lock:
+                data.version = self._next_version.get(name, 0)
+                self._loaded[name] = data
+                evicted = self._evict()
+        for evicted_name in evicted:
+            if self.on_evict is not None:
+                self.on_evict(evicted_name)
+        return data
+
+    def __contains__(self, name):
+        return isinstance(name, str) and (name in self._registered or name in self._loaded or name in self.names())
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __len__(self):
+        return len(self.names())
+
+    # Serve a dataset that is already loaded (e.g. from outside the data directory) - registered datasets are never evicted
+    def __setitem__(self, name, data):
+        with self._lock:
+            self._registered[name] = data
+
+    def __delitem__(self, name):
+        with self._lock:
+            del self._registered[name]
+
+    def info(self):
+        with self._lock:
+            return {"loaded": len(self._loaded),
+                    "bytes": sum(data.nbytes for data in self._loaded.values()),
+                    "max_bytes": self.max_bytes,
+                    "evictions": self.evictions}
+
+    # Drop least recently used datasets until the rest fit in max_bytes - called with the lock held
+    def _evict(self):
+        evicted = []
+        if self.max_bytes is None:
+            return evicted
+        total = sum(data.nbytes for data in self._loaded.values())
+        while total > self.max_bytes and len(self._loaded) > 1:
+            name, data = self._loaded.popitem(last=False)
+            total -= data.nbytes
+            self._next_version[name] = data.version + 1
+            self.evictions += 1
+            evicted.append(name)
+        return evicted
@@ -0,0 +1,171 @@
+# Static export for serving the app from a CDN without Python: python chi_export.py [--out export] [--dataset chi_happy] [--workers 4] [--force]
+# Runs the chi_controller callbacks for every (dependent, independent) pair and writes their outputs as JSON files,
+# together with the static front end in static/ that loads them
+# Only pairs with a column that changed since the last export are regenerated - use --force after changing the code
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+from itertools import permutations
+import json
+import os
+import shutil
+import plotly
+import dash_bootstrap_components as dbc
+import chi_controller
+import chi_model
+
+STATIC_DIR = "static"
+ASSETS_DIR = "assets"
+ASSET_FILES = ["style.css", "favicon.ico", "OpenSans-Regular.ttf", "OpenSans-SemiBold.ttf", "OpenSans-ExtraBold.ttf"]
+
+# Pairs exported by a worker process at a time
+CHUNK_SIZE = 8
+
+
+def write_json(path, obj):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(obj, f, cls=plotly.utils.PlotlyJSONEncoder)
+    os.replace(f"{path}.tmp", path)
+
+
+# File for a pair's results, named by a hash so any column name gives a safe, stable path
+def pair_file(y, x):
+    return f"pairs/{hashlib.sha1(f'{y}|{x}'.encode()).hexdigest()[:16]}.json"
+
+
+# Fingerprint of a column's categories and encoded values - unchanged unless the column's data changes
+def column_hash(data, col):
+    digest = hashlib.sha256(json.dumps(data.categories[data.columns.index(col)]).encode())
+    digest.update(data.codes(col).tobytes())
+    return digest.hexdigest()
+
+
+# Outputs of the submit and conclusion callbacks for one pair, as the server would send them
+def pair_results(dataset, y, x):
+    fig, sr_text, p_text, p, _, _ = chi_controller.update_bar(1, y, x, dataset)
+    null_hyp, alt_hyp, _, _, _, _ = chi_controller.update_results(1, y, x)
+    obs, obs_columns, exp, exp_columns, obs_pc, obs_pc_columns = chi_controller.update_datatables(1, y, x, dataset)
+    conclusions = {level: {choice: [span.to_plotly_json()["props"] for span in conclude(choice, p)]
+                           for choice in ("accept", "reject")}
+                   for level, conclude in (("95", chi_controller.accept_or_reject95),
+                                           ("99", chi_controller.accept_or_reject99))}
+    return {"dependent": y,
+            "independent": x,
+            "figure": fig,
+            "sr_text": sr_text,
+            "p_text": p_text,
+            "p": p,
+            "null_hyp": null_hyp,
+            "alt_hyp": alt_hyp,
+            "tables": {"table-observed": {"data": obs, "columns": obs_columns},
+                       "table-expected": {"data": exp, "columns": exp_columns},
+                       "table-observed-pc": {"data": obs_pc, "columns": obs_pc_columns}},
+            "conclusions": conclusions}
+
+
+# Worker process - export a chunk of pairs
+def export_pairs(dataset, pairs, dataset_dir):
+    for y, x in pairs:
+        write_json(os.path.join(dataset_dir, pair_file(y, x)), pair_results(dataset, y, x))
+    return len(pairs)
+
+
+def export_dataset(dataset, out, workers, force):
+    dataset_dir = os.path.join(out, dataset)
+    manifest_path = os.path.join(dataset_dir, "manifest.json")
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    data = chi_model.chi_datasets[dataset]
+    columns = chi_model.selectable_columns(dataset)
+    # Raises ValueError for a dataset that cannot be shown
+    dependent, independent = chi_model.initial_pair(dataset)
+    settings = chi_model.dataset_settings(dataset)
+    with data.lock:
+        hashes = {col: column_hash(data, col) for col in columns}
+    if force or manifest.get("settings") != settings:
+        changed = set(columns)
+    else:
+        changed = {col for col in columns if manifest.get("columns", {}).get(col) != hashes[col]}
+    pairs = list(permutations(columns, 2))
+    stale = [(y, x) for y, x in pairs
+             if y in changed or x in changed or not os.path.exists(os.path.join(dataset_dir, pair_file(y, x)))]
+
+    chunks = [stale[i:i + CHUNK_SIZE] for i in range(0, len(stale), CHUNK_SIZE)]
+    if workers <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            export_pairs(dataset, chunk, dataset_dir)
+    else:
+        with ProcessPoolExecutor(min(workers, len(chunks))) as pool:
+            list(pool.map(export_pairs, [dataset] * len(chunks), chunks, [dataset_dir] * len(chunks)))
+
+    # Results for pairs that are no longer selectable are removed
+    files = {f"{y}|{x}": pair_file(y, x) for y, x in pairs}
+    for old in set(manifest.get("files", {}).values()) - set(files.values()):
+        try:
+            os.remove(os.path.join(dataset_dir, old))
+        except FileNotFoundError:
+            pass
+
+    layout_data = chi_model.initial_layout_data(dataset)
+    write_json(os.path.join(dataset_dir, "index.json"),
+               {"columns": columns,
+                "dependent": dependent,
+                "independent": independent,
+                "figure": layout_data["figure"],
+                "sr_text": f"Bar chart of dependent variable {dependent.replace('_', ' ')} for independent variable {independent.replace('_', ' ')}",
+                "heatmap": layout_data["heatmap"],
+                "files": files})
+    # Written last, so an interrupted export is redone next time
+    write_json(manifest_path, {"columns": hashes, "settings": settings, "files": files})
+    return len(stale), len(pairs)
+
+
+# Front end, styles and Plotly for the static site
+def export_front_end(out, datasets):
+    default = chi_model.default_dataset()
+    os.makedirs(out, exist_ok=True)
+    with open(os.path.join(STATIC_DIR, "index.html")) as f:
+        index = f.read()
+    with open(os.path.join(out, "index.html"), "w") as f:
+        f.write(index.replace("{bootstrap_css}", dbc.themes.BOOTSTRAP))
+    shutil.copy(os.path.join(STATIC_DIR, "chi_static.js"), out)
+    for name in ASSET_FILES:
+        shutil.copy(os.path.join(ASSETS_DIR, name), out)
+    shutil.copy(os.path.join(os.path.dirname(plotly.__file__), "package_data", "plotly.min.js"), out)
+    write_json(os.path.join(out, "datasets.json"),
+               {"default": default if default in datasets else datasets[0],
+                "datasets": [{"label": name.replace("_", " "), "value": name} for name in datasets]})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export every pair's results and a static front end")
+    parser.add_argument("--out", default="export", help="output directory")
+    parser.add_argument("--dataset", action="append", help="dataset to export (default: all), may be repeated")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--force", action="store_true", help="regenerate every pair")
+    args = parser.parse_args()
+
+    datasets = args.dataset or chi_model.chi_datasets.names()
+    unknown = [name for name in datasets if name not in chi_model.chi_datasets]
+    if unknown:
+        parser.error(f"unknown datasets: {', '.join(unknown)}")
+    exported_datasets = []
+    for dataset in datasets:
+        try:
+            exported, total = export_dataset(dataset, args.out, args.workers, args.force)
+        except ValueError as e:
+            print(f"{dataset}: skipped - {e}")
+            continue
+        exported_datasets.append(dataset)
+        print(f"{dataset}: {exported} of {total} pairs exported")
+    if not exported_datasets:
+        parser.error("no dataset could be exported")
+    export_front_end(args.out, exported_datasets)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+from flask import jsonify
+from chi_model import chi_datasets, default_dataset
+from chi_view import app
+
+
+# Liveness - the process is serving requests
+@app.server.route("/healthz")
+def healthz():
+    return jsonify(status="ok")
+
+
+# Readiness - the dataset is loaded (results are computed on demand, so the first page can be served straight away)
+@app.server.route("/readyz")
+def readyz():
+    dataset = default_dataset()
+    data = chi_datasets.get(dataset) if dataset is not None else None
+    if data is None or data.n_rows == 0:
+        return jsonify(status="loading"), 503
+    return jsonify(status="ready", dataset=dataset, rows=data.n_rows, version=data.version)
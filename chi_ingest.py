@@ -0,0 +1,34 @@
+import hmac
+import os
+from flask import jsonify, request
+from chi_model import chi_datasets, refresh_results
+from chi_view import app
+
+# Ingest is disabled unless a token is configured - clients send it as "Authorization: Bearer <token>"
+INGEST_TOKEN = os.environ.get("CHI_INGEST_TOKEN")
+
+# Largest CSV body accepted by a single ingest request (bytes)
+INGEST_MAX_BYTES = int(os.environ.get("CHI_INGEST_MAX_BYTES", 10_000_000))
+
+
+# Append survey responses (CSV with a header row matching the dataset) without restarting the app
+# Counts are updated in O(new rows) and results for every pair are refreshed before the response is sent
+@app.server.route("/ingest/<dataset>", methods=["POST"])
+def ingest(dataset):
+    # Constant-time comparison, so response times do not reveal how much of a guessed token is correct
+    if not INGEST_TOKEN or not hmac.compare_digest(request.headers.get("Authorization", "").encode(),
+                                                   f"Bearer {INGEST_TOKEN}".encode()):
+        return jsonify(error="Ingest is not enabled or the token is invalid"), 403
+    if dataset not in chi_datasets:
+        return jsonify(error=f"Unknown dataset {dataset}"), 404
+    if request.content_length is None:
+        return jsonify(error="Content-Length is required"), 411
+    if request.content_length > INGEST_MAX_BYTES:
+        return jsonify(error=f"Request body must be at most {INGEST_MAX_BYTES} bytes"), 413
+    data = chi_datasets[dataset]
+    try:
+        rows_added = data.append_csv(request.get_data())
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    refresh_results(dataset)
+    return jsonify(dataset=dataset, rows_added=rows_added, rows=data.n_rows)
@@ -0,0 +1,235 @@
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+import math
+import os
+import sys
+import threading
+import time
+
+# Latency buckets (seconds) and payload size buckets (bytes) for the Prometheus histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Requests slower than this (milliseconds) have their sampled stacks written to PROFILE_DIR - unset to disable profiling
+PROFILE_SLOW_MS = os.environ.get("CHI_PROFILE_SLOW_MS")
+PROFILE_DIR = os.path.join("data", ".cache", "profiles")
+PROFILE_INTERVAL = 0.005
+
+# Cold start budgets (seconds) for importing the app and for its first request - times over budget are reported on stderr
+STARTUP_BUDGET = float(os.environ.get("CHI_STARTUP_BUDGET", 1))
+FIRST_REQUEST_BUDGET = float(os.environ.get("CHI_FIRST_REQUEST_BUDGET", 0.1))
+
+# Requests not counted as the first request - health checks arrive before any user
+UNTIMED_PATHS = ("/metrics", "/healthz", "/readyz")
+
+
+# Prometheus histogram with one series per label value, safe to update from several threads
+class Histogram:
+    def __init__(self, name, help_text, label, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, (buckets, count, total) in sorted(self._series.items()):
+                label = f'{self.label}="{_escape(label_value)}"'
+                cumulative = 0
+                for bound, n in zip(self.buckets, buckets):
+                    cumulative += n
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+                lines.append(f"{self.name}_sum{{{label}}} {total}")
+                lines.append(f"{self.name}_count{{{label}}} {count}")
+        return lines
+
+
+stage_seconds = Histogram("chi_stage_seconds", "Time spent in each stage of a computation",
+                          "stage", LATENCY_BUCKETS)
+callback_seconds = Histogram("chi_callback_seconds", "Time spent in each Dash callback function",
+                             "callback", LATENCY_BUCKETS)
+request_seconds = Histogram("chi_request_seconds", "HTTP request latency, including JSON serialisation",
+                            "callback", LATENCY_BUCKETS)
+response_bytes = Histogram("chi_response_bytes", "HTTP response payload size",
+                           "callback", SIZE_BUCKETS)
+
+# Other metrics are read when /metrics is scraped: (name, type, help, function returning the value)
+collectors = []
+
+in_flight = 0
+_in_flight_lock = threading.Lock()
+
+# Time taken to import the app and to serve the first request in this process (NaN until measured)
+startup_seconds = float("nan")
+first_request_seconds = float("nan")
+
+# Sampled stacks per thread currently handling a request (profiling only)
+_profiles = {}
+
+
+# Time a block of work - with stage("scipy"): ... - or every call of a function - @stage("figure")
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(name, time.perf_counter() - start)
+
+
+# Time every call of a Dash callback function
+def instrumented(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            callback_seconds.observe(func.__name__, time.perf_counter() - start)
+    return wrapper
+
+
+def add_metric(name, kind, help_text, func):
+    collectors.append((name, kind, help_text, func))
+
+
+# Record the time taken to import the app - called by the entry point (wsgi.py)
+def record_startup(seconds):
+    global startup_seconds
+    startup_seconds = seconds
+    _check_budget("Startup", seconds, STARTUP_BUDGET)
+
+
+def _check_budget(name, seconds, budget):
+    if seconds > budget:
+        print(f"{name} took {seconds:.3f} s, over its budget of {budget} s", file=sys.stderr)
+
+
+def render():
+    lines = []
+    for histogram in (stage_seconds, callback_seconds, request_seconds, response_bytes):
+        lines.extend(histogram.render())
+    lines += ["# HELP chi_requests_in_flight HTTP requests currently being handled",
+              "# TYPE chi_requests_in_flight gauge",
+              f"chi_requests_in_flight {in_flight}"]
+    for name, help_text, value in (("chi_startup_seconds", "Time taken to import the app", startup_seconds),
+                                   ("chi_startup_budget_seconds", "Budget for importing the app", STARTUP_BUDGET),
+                                   ("chi_first_request_seconds", "Latency of the first request", first_request_seconds),
+                                   ("chi_first_request_budget_seconds", "Budget for the first request", FIRST_REQUEST_BUDGET)):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+    for name, kind, help_text, func in collectors:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {func()}"]
+    return "\n".join(lines) + "\n"
+
+
+# Label values escaped as the Prometheus text format requires
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Name used to label a request - the outputs of a registered Dash callback, or the matched URL rule
+# Labels never come straight from the client, so the number of series stays bounded
+def _request_label(request, callback_map):
+    if request.path.endswith("_dash-update-component"):
+        body = request.get_json(silent=True) or {}
+        output = body.get("output")
+        return output.strip(".") if isinstance(output, str) and output in callback_map() else "unknown"
+    return request.url_rule.rule if request.url_rule is not None else "other"
+
+
+# Record latency, payload size and in-flight requests for every request, and serve /metrics
+# callback_map returns the app's registered Dash callbacks by output
+def init_app(server, callback_map=dict):
+    from flask import Response, g, request
+
+    @server.before_request
+    def start_request():
+        global in_flight
+        g.chi_start = time.perf_counter()
+        with _in_flight_lock:
+            in_flight += 1
+        if PROFILE_SLOW_MS:
+            _start_sampler()
+            _profiles[threading.get_ident()] = Counter()
+
+    @server.after_request
+    def record_response(response):
+        if request.path != "/metrics" and response.content_length is not None:
+            response_bytes.observe(_request_label(request, callback_map), response.content_length)
+        return response
+
+    @server.teardown_request
+    def finish_request(exc):
+        global in_flight, first_request_seconds
+        with _in_flight_lock:
+            in_flight -= 1
+        if "chi_start" not in g or request.path == "/metrics":
+            return
+        elapsed = time.perf_counter() - g.chi_start
+        if math.isnan(first_request_seconds) and request.path not in UNTIMED_PATHS:
+            first_request_seconds = elapsed
+            _check_budget(f"First request ({request.path})", elapsed, FIRST_REQUEST_BUDGET)
+        label = _request_label(request, callback_map)
+        request_seconds.observe(label, elapsed)
+        stacks = _profiles.pop(threading.get_ident(), None)
+        if stacks and elapsed * 1000 >= float(PROFILE_SLOW_MS):
+            _write_profile(label, stacks)
+
+    @server.route("/metrics")
+    def metrics():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
+
+
+# Start the sampling thread in this process - threads do not survive the fork into pre-forked workers, so it starts on first request
+_sampler_pid = None
+_sampler_lock = threading.Lock()
+
+
+def _start_sampler():
+    global _sampler_pid
+    with _sampler_lock:
+        if _sampler_pid != os.getpid():
+            _sampler_pid = os.getpid()
+            threading.Thread(target=_sample_stacks, daemon=True).start()
+
+
+# Sampling profiler - records the stack of every thread handling a request every PROFILE_INTERVAL seconds
+def _sample_stacks():
+    while True:
+        time.sleep(PROFILE_INTERVAL)
+        frames = sys._current_frames()
+        for ident, stacks in list(_profiles.items()):
+            frame = frames.get(ident)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if names:
+                stacks[";".join(reversed(names))] += 1
+
+
+# Write sampled stacks in folded format, ready for flamegraph.pl or speedscope
+def _write_profile(label, stacks):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = "".join(c if c.isalnum() or c in "-_" else "_" for c in label)[:80]
+    with open(os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}.folded"), "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
@@ -1,80 +1,576 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import combinations, permutations
+import json
+import os
+import time
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
-import scipy.stats as stat
-
-# Generate dataframe from csv
-chi_happy = pd.read_csv("data/chi_happy.csv")
-
-# Colour palette
-stat_colours = {
-    "UK": "#d10373",
-    "EU": "#9eab05",
-    "International": "#0085a1",
-    "Y": "#d10373",
-    "N": "#9eab05",
-    "F": "#9eab05",
-    "M": "#d10373",
-    "Extrovert": "#d10373",
-    "Introvert": "#9eab05"
-}
-
-# Filter dataframe, perform Chi-squared test and return data for graph and DataTables
-def calc_chi2_ind(y, x):
-    dff = chi_happy[[y, x]].dropna().reset_index(drop=True)
-    # ct: data for Observed Values DataTable
-    ct = pd.crosstab(index=dff[y],
-                     columns=dff[x],
-                     margins=True,
-                     margins_name="Expected")
-    # ct: data for Observed Values (percentages) DataTable
-    ct_norm = pd.crosstab(index=dff[y],
-                          columns=dff[x],
-                          normalize="columns",
-                          margins=True,
-                          margins_name="Expected")
-    # ct_t: data for bar chart
-    ct_t = pd.crosstab(index=dff[y],
-                       columns=dff[x],
-                       normalize="columns",
-                       margins=True,
-                       margins_name="Expected").transpose()
-    # ct_table: data for Expected Values DataTable
-    ct_table = pd.crosstab(index=dff[y],
-                           columns=dff[x],
-                           margins=True,
-                           margins_name="Expected").transpose()
-    dep_cat = dff[y].unique()
-    ind_cat = dff[x].unique()
-    chi2, p, dof, expected = stat.chi2_contingency(ct, correction=True)
+import plotly.io as pio
+from chi_cache import ResultCache
+from chi_metrics import add_metric, stage
+from chi_data import CACHE_DIR, COUNT_CHUNK_ROWS, MAX_CATEGORIES, DatasetRegistry, count_pair, count_permuted_files, fcntl, sort_labels
+
+# Dataset shown when the app is first opened, and used when a request does not name one
+DATASET = "chi_happy"
+
+# Memory (MB) that loaded datasets may hold before the least recently used are evicted
+DATASET_MEMORY_MB = float(os.environ.get("CHI_DATASET_MEMORY_MB", 512))
+
+# Column whose values define the strata (survey samples) for stratified analysis - not selectable as a variable
+STRATUM = "sample"
+
+# Colours for the categories of a variable, in sorted category order
+palette = ["#d10373", "#9eab05", "#0085a1", "#f28c00", "#6c3483", "#1e8449", "#7f8c8d", "#c0392b"]
+
+
+# Results derived from a dataset, dropped from the UI and batch caches when it is evicted
+def drop_results(dataset):
+    for cache in (chi_cache, batch_cache):
+        cache.discard(lambda key: key[0] == dataset)
+    chi_cache.release(dataset)
+
+
+# Survey files under data/ are streamed into pairwise category counts the first time each is selected
+# Persisted counts are reused on restart while the file is unchanged; results for an evicted dataset are dropped from the caches
+chi_datasets = DatasetRegistry(max_bytes=DATASET_MEMORY_MB * 1024 ** 2,
+                               on_evict=drop_results)
+
+
+# Variables offered for a dataset - every column other than the stratum with at most MAX_CATEGORIES categories
+def selectable_columns(dataset=DATASET):
+    data = chi_datasets[dataset]
+    return [col for col in data.columns
+            if col != STRATUM and 0 < data.n_categories(col) <= MAX_CATEGORIES]
+
+
+# Optional presentation settings for a dataset, read from data/<name>.json next to the survey file:
+# {"colours": {category: colour}, "abbreviations": {category: short label for table headers}}
+def dataset_settings(dataset=DATASET):
+    path = os.path.splitext(chi_datasets[dataset].path)[0] + ".json"
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# Bar colours for each category of a column - palette colours in sorted order unless set in the dataset settings
+def category_colours(dataset, column):
+    data = chi_datasets[dataset]
+    colours = dataset_settings(dataset).get("colours", {})
+    labels = sort_labels(data.categories[data.columns.index(column)])
+    return {label: colours.get(label, palette[n % len(palette)]) for n, label in enumerate(labels)}
+
+
+# Return cached column headers for the Observed vs expected proportions DataTable, for every category of the selectable columns
+# Kept per version of the data, like the colours in each figure, so a submit does not read the settings file or scan every category
+def pc_column_labels(dataset=DATASET):
+    data = chi_datasets[dataset]
+    data.sync(SYNC_INTERVAL)
+    return chi_cache.get_or_compute((dataset, data.version, "pc_labels"),
+                                    lambda: compute_pc_column_labels(dataset))
+
+
+def compute_pc_column_labels(dataset=DATASET):
+    data = chi_datasets[dataset]
+    abbreviations = dataset_settings(dataset).get("abbreviations", {})
+    labels = {label: f"{abbreviations.get(label, label)} (obs)"
+              for column in selectable_columns(dataset)
+              for label in data.categories[data.columns.index(column)]}
+    labels["Expected"] = "Expected"
+    return labels
+
+
+# Drop categories with no observations for a pair, as pd.crosstab does
+def observed_table(counts, y_labels, x_labels):
+    keep_rows = counts.sum(axis=1) > 0
+    keep_cols = counts.sum(axis=0) > 0
+    return (counts[keep_rows][:, keep_cols],
+            np.asarray(y_labels, dtype=object)[keep_rows],
+            np.asarray(x_labels, dtype=object)[keep_cols])
+
+
+# Derive DataTable/graph data and Chi-squared test results from a single array of counts
+def contingency_tables(counts, y_labels, x_labels, y, x):
+    counts, dep_cat, ind_cat = observed_table(counts, y_labels, x_labels)
+    row_totals = counts.sum(axis=1)
+    col_totals = counts.sum(axis=0)
+    total = counts.sum()
+    with stage("pandas"):
+        index = pd.Index(list(dep_cat) + ["Expected"], name=y)
+        columns = pd.Index(list(ind_cat) + ["Expected"], name=x)
+        # ct: data for Observed Values DataTable
+        margins = np.empty((len(index), len(columns)), dtype=np.int64)
+        margins[:-1, :-1] = counts
+        margins[:-1, -1] = row_totals
+        margins[-1, :-1] = col_totals
+        margins[-1, -1] = total
+        ct = pd.DataFrame(margins, index=index, columns=columns)
+        # ct_norm: data for Observed Values (percentages) DataTable
+        proportions = np.column_stack([counts / col_totals, row_totals / total])
+        ct_norm = pd.DataFrame(proportions, index=index[:-1], columns=columns)
+        # ct_t: data for bar chart
+        ct_t = ct_norm.transpose()
+        # ct_table: data for Expected Values DataTable
+        ct_table = ct.transpose()
+    with stage("scipy"):
+        # scipy.stats takes longer to import than the rest of the app together, so it is imported when first needed rather than at startup
+        import scipy.stats as stat
+        chi2, p, dof, expected = stat.chi2_contingency(margins, correction=True)
     return ct, ct_norm, ct_t, ct_table, dep_cat, ind_cat, chi2, p, dof, expected
 
 
-def create_blank_fig():
-    ct = pd.crosstab(index=chi_happy["Sex"],
-                     columns=chi_happy["UK_citizen"],
-                     normalize="columns",
-                     margins=True,
-                     margins_name="Expected").transpose()
-    data = []
-    for x in ct.columns:
-        data.append(go.Bar(name=str(x),
-                           x=ct.index,
-                           y=ct[x],
-                           marker_color=stat_colours[str(x)],
-                           marker_opacity=0.7,
-                           hovertemplate="Proportion: %{y:.2%}<extra></extra>"))
-    blank_fig = go.Figure(data)
-    blank_fig.update_layout(barmode="stack",
-                            margin=dict(t=20, b=10, l=20, r=20),
-                            height=400,
-                            font_size=14,
-                            dragmode=False,
-                            legend_title_text="UK citizen",
-                            legend_title_font_size=14,
-                            xaxis_type="category")
-    blank_fig.update_xaxes(tick0=ct.index[0],
-                           dtick=1,
-                           title_text="Sex")
-    blank_fig.update_yaxes(title_text=f"Proportion (UK citizen)",
-                           range=[0,1])
-    return blank_fig
+# Perform Chi-squared test and return data for graph and DataTables
+def compute_chi2_ind(y, x, dataset=DATASET):
+    with stage("counts"):
+        counts, y_labels, x_labels = chi_datasets[dataset].pair_counts(y, x)
+    return contingency_tables(counts, y_labels, x_labels, y, x)
+
+
+# Results shared by all callbacks for a submit, keyed on (dataset, data version, dependent, independent)
+# Entries for superseded data versions are never requested again and age out of the LRU cache
+chi_cache = ResultCache(maxsize=int(os.environ.get("CHI_CACHE_SIZE", 256)))
+add_metric("chi_cache_hits_total", "counter", "Result cache hits", lambda: chi_cache.info()["hits"])
+add_metric("chi_cache_misses_total", "counter", "Result cache misses", lambda: chi_cache.info()["misses"])
+add_metric("chi_cache_entries", "gauge", "Entries in the result cache", lambda: chi_cache.info()["size"])
+
+# Batch API results are kept apart from the UI cache, so a large batch request cannot evict the results, figures and layout users need
+batch_cache = ResultCache(maxsize=int(os.environ.get("CHI_BATCH_CACHE_SIZE", 1024)))
+add_metric("chi_batch_cache_entries", "gauge", "Entries in the batch API result cache", lambda: batch_cache.info()["size"])
+add_metric("chi_datasets_loaded", "gauge", "Datasets held in memory", lambda: chi_datasets.info()["loaded"])
+add_metric("chi_dataset_bytes", "gauge", "Memory held by loaded datasets", lambda: chi_datasets.info()["bytes"])
+add_metric("chi_dataset_evictions_total", "counter", "Datasets evicted to stay under CHI_DATASET_MEMORY_MB", lambda: chi_datasets.info()["evictions"])
+
+# Seconds between checks for rows appended to the survey file by another process
+SYNC_INTERVAL = float(os.environ.get("CHI_SYNC_INTERVAL", 5))
+
+
+# Return cached results for the selected pair - results are shared between callbacks and must not be modified in place
+def calc_chi2_ind(y, x, dataset=DATASET):
+    data = chi_datasets[dataset]
+    data.sync(SYNC_INTERVAL)
+    return chi_cache.get_or_compute((dataset, data.version, y, x),
+                                    lambda: compute_chi2_ind(y, x, dataset))
+
+
+# Results for one pair in the form returned by the batch API (see chi_api.py)
+def chi2_record(dataset, y, x, dep_cat, ind_cat, counts, expected, chi2, p, dof):
+    return {"dataset": dataset,
+            "dependent": y,
+            "independent": x,
+            "dependent_categories": [str(c) for c in dep_cat],
+            "independent_categories": [str(c) for c in ind_cat],
+            "counts": counts.tolist(),
+            "expected": expected.tolist(),
+            "chi2": float(chi2),
+            "p": float(p),
+            "dof": int(dof)}
+
+
+# Chi-squared results for many (dataset, dependent, independent) pairs, matching calc_chi2_ind
+# Each table is tested with its margins, as in contingency_tables, and tables of the same shape are stacked and tested together
+# (the continuity correction scipy applies when dof is 1 never changes the result: that only happens for 1 x 1 tables, where observed equals expected)
+@stage("batch")
+def compute_chi2_batch(pairs):
+    import scipy.stats as stat
+    tables = [observed_table(*chi_datasets[dataset].pair_counts(y, x)) for dataset, y, x in pairs]
+    by_shape = {}
+    for n, (counts, _, _) in enumerate(tables):
+        by_shape.setdefault(counts.shape, []).append(n)
+    results = [None] * len(pairs)
+    for (n_y, n_x), members in by_shape.items():
+        counts = np.stack([tables[n][0] for n in members])
+        margins = np.empty((len(members), n_y + 1, n_x + 1), dtype=np.int64)
+        margins[:, :-1, :-1] = counts
+        margins[:, :-1, -1] = counts.sum(axis=2)
+        margins[:, -1, :-1] = counts.sum(axis=1)
+        margins[:, -1, -1] = counts.sum(axis=(1, 2))
+        expected = margins[:, :-1, -1, None] * margins[:, -1, None, :-1] / margins[:, -1, -1, None, None]
+        chi2 = pearson_chi2(margins)
+        p = stat.chi2.sf(chi2, n_y * n_x)
+        for k, n in enumerate(members):
+            dataset, y, x = pairs[n]
+            _, dep_cat, ind_cat = tables[n]
+            results[n] = chi2_record(dataset, y, x, dep_cat, ind_cat, counts[k], expected[k], chi2[k], p[k], n_y * n_x)
+    return results
+
+
+# Return batch API results for many pairs - cached per pair in batch_cache, reusing results already computed for the UI
+# Only pairs missing from the caches are computed, together in one pass; results of batches larger than batch_cache are not cached
+def calc_chi2_batch(pairs):
+    for dataset in {dataset for dataset, _, _ in pairs}:
+        chi_datasets[dataset].sync(SYNC_INTERVAL)
+    keys = [(dataset, chi_datasets[dataset].version, "batch", y, x) for dataset, y, x in pairs]
+    results = [batch_cache.get(key) for key in keys]
+    for n, (dataset, version, _, y, x) in enumerate(keys):
+        if results[n] is None:
+            ui_results = chi_cache.get((dataset, version, y, x))
+            if ui_results is not None:
+                ct, _, _, _, dep_cat, ind_cat, chi2, p, dof, expected = ui_results
+                results[n] = chi2_record(dataset, y, x, dep_cat, ind_cat,
+                                         ct.values[:-1, :-1], expected[:-1, :-1], chi2, p, dof)
+    missing = [n for n, result in enumerate(results) if result is None]
+    cache_results = len(missing) <= batch_cache.maxsize
+    for n, result in zip(missing, compute_chi2_batch([pairs[n] for n in missing])):
+        if cache_results:
+            batch_cache.put(keys[n], result)
+        results[n] = result
+    return results
+
+
+# Layout shared by every bar chart, validated by Plotly once - figures are then assembled as plain dicts
+# Built on first use rather than at import, as validation loads most of Plotly's validators
+@lru_cache(maxsize=None)
+def bar_layout():
+    return go.Layout(template=pio.templates[pio.templates.default],
+                     barmode="stack",
+                     margin=dict(t=20, b=10, l=20, r=20),
+                     height=400,
+                     font_size=14,
+                     dragmode=False).to_plotly_json()
+
+
+# Stacked bar chart of column proportions (ct_t) as a figure dict, skipping Plotly object construction and validation
+@stage("figure")
+def bar_figure(ct_t, legend_title, x_title, y_title, colours):
+    x = list(ct_t.index)
+    data = [{"type": "bar",
+             "name": str(c),
+             "x": x,
+             "y": ct_t[c].tolist(),
+             "marker": {"color": colours[str(c)], "opacity": 0.7},
+             "hovertemplate": "Proportion: %{y:.2%}<extra></extra>"}
+            for c in ct_t.columns]
+    layout = dict(bar_layout(),
+                  legend={"title": {"text": legend_title, "font": {"size": 14}}},
+                  xaxis={"type": "category", "tick0": x[0], "dtick": 1, "title": {"text": x_title}},
+                  yaxis={"title": {"text": y_title}, "range": [0, 1]})
+    return {"data": data, "layout": layout}
+
+
+# Return the cached bar chart for the selected pair - shared between requests and must not be modified in place
+def calc_bar_fig(y, x, dataset=DATASET):
+    data = chi_datasets[dataset]
+    data.sync(SYNC_INTERVAL)
+    return chi_cache.get_or_compute((dataset, data.version, "figure", y, x),
+                                    lambda: bar_figure(calc_chi2_ind(y, x, dataset)[2], y, x, f"Proportion ({y})",
+                                                       category_colours(dataset, y)))
+
+
+# Compute results and bar charts for every (dependent, independent) pair of the current data
+# Not run at import so the development server starts without scipy - gunicorn runs it in the master before forking workers (see gunicorn.conf.py)
+# The cache keeps room for them all (results, figures, table headers, layout and association matrix) on top of CHI_CACHE_SIZE,
+# so warming a dataset with many variables never evicts its own results
+def refresh_results(dataset=DATASET):
+    pairs = list(permutations(selectable_columns(dataset), 2))
+    chi_cache.reserve(dataset, 2 * len(pairs) + 3)
+    pc_column_labels(dataset)
+    for pair in pairs:
+        calc_chi2_ind(*pair, dataset=dataset)
+        calc_bar_fig(*pair, dataset=dataset)
+
+
+# Cramér's V and Chi-squared p-values for every pair of columns in one batched pass
+# The p-values are the ones calc_chi2_ind shows for the pair: it tests the table with its "Expected" margins, which adds nothing to
+# the statistic (margin cells match their expected counts) but gives rows * columns degrees of freedom rather than (rows - 1) * (columns - 1)
+# Pair tables with the same shape are stacked and tested together, so the cost grows with the number of pairs and categories, not rows
+@stage("association")
+def compute_association(columns, dataset=DATASET):
+    import scipy.stats as stat
+    pairs = list(combinations(columns, 2))
+    tables = [chi_datasets[dataset].pair_counts(y, x)[0] for y, x in pairs]
+    cramers_v = pd.DataFrame(np.nan, index=columns, columns=columns)
+    p_values = pd.DataFrame(np.nan, index=columns, columns=columns)
+    by_shape = {}
+    for n, table in enumerate(tables):
+        by_shape.setdefault(table.shape, []).append(n)
+    for members in by_shape.values():
+        counts = np.stack([tables[n] for n in members]).astype(float)
+        rows = counts.sum(axis=2)
+        cols = counts.sum(axis=1)
+        total = rows.sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            expected = rows[:, :, None] * cols[:, None, :] / total[:, None, None]
+            chi2 = np.where(expected > 0, (counts - expected) ** 2 / expected, 0).sum(axis=(1, 2))
+            # Categories with no observations for a pair do not count towards its dimensions
+            n_rows = (rows > 0).sum(axis=1)
+            n_cols = (cols > 0).sum(axis=1)
+            p = stat.chi2.sf(chi2, n_rows * n_cols)
+            v = np.sqrt(chi2 / (total * (np.minimum(n_rows, n_cols) - 1)))
+        for n, pair_v, pair_p in zip(members, v, p):
+            y, x = pairs[n]
+            cramers_v.loc[y, x] = cramers_v.loc[x, y] = pair_v
+            p_values.loc[y, x] = p_values.loc[x, y] = pair_p
+    return cramers_v, p_values
+
+
+# Worker processes used by permutation tests - in total across every test running on the host, however many users start one
+PERMUTATION_WORKERS = max(1, int(os.environ.get("CHI_PERMUTATION_WORKERS", os.cpu_count() or 1)))
+PERMUTATION_SLOTS_DIR = os.path.join(CACHE_DIR, "permutation")
+
+# Largest number of permuted values shuffled together in one batch - larger inputs are shuffled one permutation at a time
+# and counted in row chunks (see chi_data.count_permuted)
+PERMUTATION_BATCH_ELEMENTS = COUNT_CHUNK_ROWS
+
+
+# Pearson Chi-squared statistic for a stack of tables (last two axes) - cells with no expected count are skipped
+def pearson_chi2(counts):
+    rows = counts.sum(axis=-1)
+    cols = counts.sum(axis=-2)
+    total = rows.sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = rows[..., :, None] * cols[..., None, :] / total[..., None, None]
+        return np.where(expected > 0, (counts - expected) ** 2 / expected, 0).sum(axis=(-2, -1))
+
+
+# Reserve up to n of the PERMUTATION_WORKERS worker slots, waiting until at least one is free
+# Slots are file locks shared by every process using the cache directory (gunicorn workers and background callbacks),
+# released when the test finishes or its process exits - without fcntl (Windows) slots are not shared between processes
+@contextmanager
+def permutation_slots(n):
+    if fcntl is None:
+        yield n
+        return
+    os.makedirs(PERMUTATION_SLOTS_DIR, exist_ok=True)
+    held = []
+    try:
+        while not held:
+            for k in range(PERMUTATION_WORKERS):
+                if len(held) == n:
+                    break
+                f = open(os.path.join(PERMUTATION_SLOTS_DIR, f"slot_{k}.lock"), "w")
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    held.append(f)
+                except BlockingIOError:
+                    f.close()
+            if not held:
+                time.sleep(0.1)
+        yield len(held)
+    finally:
+        for f in held:
+            f.close()
+
+
+# Monte Carlo permutation test of independence - reliable where the asymptotic p-value is not (sparse tables, small samples)
+# Batches of shuffles are spread across a process pool; each batch has its own seed spawned from seed, so results do not depend on the number of workers
+# Each worker holds a copy of the rows with values in both columns (a few bytes per row) plus temporaries bounded by COUNT_CHUNK_ROWS
+# progress(done, iterations) is called as batches complete and may raise to cancel the test
+@stage("permutation")
+def permutation_test(y, x, iterations=10000, seed=0, dataset=DATASET, progress=None, workers=PERMUTATION_WORKERS):
+    data = chi_datasets[dataset]
+    with data.lock:
+        n_rows = data.n_rows
+        y_file, x_file = data.codes_file(y), data.codes_file(x)
+        n_y, n_x = data.n_categories(y), data.n_categories(x)
+    y_codes = np.memmap(y_file[0], dtype=y_file[1], mode="r", shape=(n_rows,))
+    x_codes = np.memmap(x_file[0], dtype=x_file[1], mode="r", shape=(n_rows,))
+    observed = count_pair(y_codes, x_codes, n_y, n_x)
+    n_values = int(observed.sum())
+    chi2 = pearson_chi2(observed)
+    size = max(1, min(iterations, PERMUTATION_BATCH_ELEMENTS // max(n_values, 1)))
+    sizes = [size] * (iterations // size) + ([iterations % size] if iterations % size else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    batches = [(y_file, x_file, n_rows, n_values, n_y, n_x, batch_seed, batch_size)
+               for batch_seed, batch_size in zip(seeds, sizes)]
+    exceed = 0
+    done = 0
+
+    def add_batch(counts):
+        nonlocal exceed, done
+        # Tolerance so permutations equal to the observed table are counted despite rounding
+        exceed += int((pearson_chi2(counts) >= chi2 - 1e-9 * max(chi2, 1)).sum())
+        done += len(counts)
+        if progress is not None:
+            progress(done, iterations)
+
+    with permutation_slots(max(1, min(workers, len(batches)))) as n_workers:
+        if n_workers == 1:
+            for batch in batches:
+                add_batch(count_permuted_files(*batch))
+        else:
+            with ProcessPoolExecutor(n_workers) as pool:
+                futures = [pool.submit(count_permuted_files, *batch) for batch in batches]
+                try:
+                    for future in as_completed(futures):
+                        add_batch(future.result())
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+    return chi2, (exceed + 1) / (iterations + 1)
+
+
+# Generalised Cochran-Mantel-Haenszel test of association for a stack of stratum tables (strata, rows, columns)
+# Returns the statistic, degrees of freedom and p-value; strata with fewer than two observations carry no information and are skipped
+def cmh_test(counts):
+    import scipy.stats as stat
+    n = counts.sum(axis=(1, 2))
+    counts = counts[n > 1].astype(float)
+    n = n[n > 1].astype(float)
+    counts = counts[:, counts.sum(axis=(0, 2)) > 0][:, :, counts.sum(axis=(0, 1)) > 0]
+    n_strata, n_y, n_x = counts.shape
+    dof = (n_y - 1) * (n_x - 1)
+    if n_strata == 0 or dof == 0:
+        return np.nan, dof, np.nan
+    row_p = counts.sum(axis=2) / n[:, None]
+    col_p = counts.sum(axis=1) / n[:, None]
+    expected = n[:, None, None] * row_p[:, :, None] * col_p[:, None, :]
+    # Deviations of the first (rows - 1) x (columns - 1) cells, summed over strata
+    deviation = (counts - expected)[:, :-1, :-1].sum(axis=0).ravel()
+    row_v = (np.einsum("ka,ab->kab", row_p[:, :-1], np.eye(n_y - 1))
+             - row_p[:, :-1, None] * row_p[:, None, :-1])
+    col_v = (np.einsum("ka,ab->kab", col_p[:, :-1], np.eye(n_x - 1))
+             - col_p[:, :-1, None] * col_p[:, None, :-1])
+    weight = n ** 2 / (n - 1)
+    variance = np.einsum("k,kab,kcd->acbd", weight, row_v, col_v).reshape(dof, dof)
+    statistic = float(deviation @ np.linalg.pinv(variance) @ deviation)
+    return statistic, dof, stat.chi2.sf(statistic, dof)
+
+
+# Per-stratum Chi-squared results and the pooled CMH test, from a strata x rows x columns array of counts built in one pass
+@stage("strata")
+def compute_strata(y, x, dataset=DATASET):
+    import scipy.stats as stat
+    data = chi_datasets[dataset]
+    with data.lock:
+        s_codes, y_codes, x_codes = data.codes(STRATUM), data.codes(y), data.codes(x)
+        n_s, n_y, n_x = data.n_categories(STRATUM), data.n_categories(y), data.n_categories(x)
+        s_labels = list(data.categories[data.columns.index(STRATUM)])
+    has_values = (s_codes >= 0) & (y_codes >= 0) & (x_codes >= 0)
+    combined = ((s_codes[has_values].astype(np.int64) * n_y + y_codes[has_values]) * n_x
+                + x_codes[has_values])
+    counts = np.bincount(combined, minlength=n_s * n_y * n_x).reshape(n_s, n_y, n_x)
+    chi2 = pearson_chi2(counts)
+    dof = ((counts.sum(axis=2) > 0).sum(axis=1) - 1) * ((counts.sum(axis=1) > 0).sum(axis=1) - 1)
+    with np.errstate(invalid="ignore"):
+        p = np.where(dof > 0, stat.chi2.sf(chi2, np.maximum(dof, 1)), np.nan)
+    strata = pd.DataFrame({"n": counts.sum(axis=(1, 2)),
+                           "chi2": chi2,
+                           "dof": dof,
+                           "p": p},
+                          index=pd.Index(s_labels, name=STRATUM))
+    strata = strata[strata["n"] > 0].loc[sort_labels(strata.index[strata["n"] > 0])]
+    return strata, cmh_test(counts)
+
+
+# Return cached stratified results for the selected pair
+def calc_strata(y, x, dataset=DATASET):
+    data = chi_datasets[dataset]
+    data.sync(SYNC_INTERVAL)
+    return chi_cache.get_or_compute((dataset, data.version, "strata", y, x),
+                                    lambda: compute_strata(y, x, dataset))
+
+
+# Return cached Cramér's V and p-value matrices for all selectable columns
+def association_matrix(dataset=DATASET):
+    data = chi_datasets[dataset]
+    data.sync(SYNC_INTERVAL)
+    return chi_cache.get_or_compute((dataset, data.version, "association"),
+                                    lambda: compute_association(selectable_columns(dataset), dataset))
+
+
+# Counts and test results for every pair, shipped to the browser in client-side mode (see assets/chi_clientside.js)
+def clientside_data(dataset=DATASET):
+    pairs = {}
+    columns = selectable_columns(dataset)
+    for y, x in permutations(columns, 2):
+        ct, _, _, _, dep_cat, ind_cat, _, p, _, expected = calc_chi2_ind(y, x, dataset)
+        pairs[f"{y}|{x}"] = {"dep_cat": [str(c) for c in dep_cat],
+                             "ind_cat": [str(c) for c in ind_cat],
+                             "counts": ct.values[:-1, :-1].tolist(),
+                             "expected": np.round(expected, 2)[:-1].tolist(),
+                             "p": float(p)}
+    return {"pairs": pairs,
+            "colours": {column: category_colours(dataset, column) for column in columns},
+            "pc_labels": pc_column_labels(dataset),
+            "template": bar_layout()["template"]}
+
+
+# Variables selected when a dataset is first shown (dependent, independent)
+# Raises ValueError for a dataset with fewer than two variables, which cannot be shown
+def initial_pair(dataset=DATASET):
+    columns = selectable_columns(dataset)
+    if len(columns) < 2:
+        raise ValueError(f"{dataset} has fewer than two variables to compare")
+    return columns[1], columns[0]
+
+
+# Dataset shown when the page is loaded - DATASET, or the first survey file found when it is not available (None if there are none)
+def default_dataset():
+    if DATASET in chi_datasets:
+        return DATASET
+    return next(iter(chi_datasets.names()), None)
+
+
+def create_blank_fig(dataset=DATASET):
+    y, x = initial_pair(dataset)
+    _, _, ct, _, _, _, _, _, _, _ = calc_chi2_ind(y, x, dataset)
+    return bar_figure(ct, y.replace("_", " "), x.replace("_", " "), f"Proportion ({y.replace('_', ' ')})",
+                      category_colours(dataset, y))
+
+
+# Heatmap of Cramér's V for every pair of variables, with p-values shown on hover
+def create_association_fig(dataset=DATASET):
+    cramers_v, p_values = association_matrix(dataset)
+    fig = go.Figure(go.Heatmap(z=cramers_v.values,
+                               x=cramers_v.columns,
+                               y=cramers_v.index,
+                               customdata=p_values.values,
+                               zmin=0,
+                               zmax=1,
+                               colorscale=[[0, "#ffffff"], [1, "#d10373"]],
+                               colorbar_title_text="Cramér's V",
+                               texttemplate="%{z:.2f}",
+                               hovertemplate="%{y} and %{x}<br>Cramér's V: %{z:.3f}<br>P value: %{customdata:.3f}<extra></extra>"))
+    fig.update_layout(margin=dict(t=20, b=10, l=20, r=20),
+                      height=500,
+                      font_size=14,
+                      dragmode=False)
+    fig.update_xaxes(type="category")
+    fig.update_yaxes(type="category",
+                     autorange="reversed")
+    return fig
+
+
+# Figures and client-side data for the initial page, built ahead of time (python chi_build.py) and persisted with the dataset
+# A cold start then serves the first page from disk without computing any results - the file is rebuilt when the survey file changes
+# or LAYOUT_FORMAT is raised, which is needed whenever a change to the code changes the figures stored in it
+LAYOUT_FORMAT = 2
+
+
+def initial_layout_data(dataset=DATASET):
+    data = chi_datasets[dataset]
+    data.sync(SYNC_INTERVAL)
+    return chi_cache.get_or_compute((dataset, data.version, "layout"),
+                                    lambda: load_layout_data(dataset))
+
+
+def load_layout_data(dataset=DATASET):
+    data = chi_datasets[dataset]
+    path = os.path.join(data.cache_dir, "layout.json")
+    source = data.source
+    settings = dataset_settings(dataset)
+    try:
+        with open(path) as f:
+            layout_data = json.load(f)
+        if (layout_data["format"] == LAYOUT_FORMAT and layout_data["source"] == source
+                and layout_data["settings"] == settings):
+            return layout_data
+    except (OSError, ValueError, KeyError):
+        pass
+    layout_data = {"format": LAYOUT_FORMAT,
+                   "source": source,
+                   "settings": settings,
+                   "figure": create_blank_fig(dataset),
+                   # Serialised as Dash would serialise the figure when sending the layout
+                   "heatmap": json.loads(pio.to_json(create_association_fig(dataset))),
+                   "pair_store": clientside_data(dataset)}
+    # Written under a temporary name so other workers never read a partial file
+    with open(f"{path}.{os.getpid()}.tmp", "w") as f:
+        json.dump(layout_data, f)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+    return layout_data
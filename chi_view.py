@@ -1,127 +1,273 @@
-from dash import Dash, html, dcc
+import os
+import diskcache
+from dash import Dash, CeleryManager, DiskcacheManager, html, dcc, dash_table
 import dash_bootstrap_components as dbc
-from chi_model import chi_happy, create_blank_fig
+import chi_metrics
+from chi_model import chi_datasets, default_dataset, initial_layout_data, initial_pair, selectable_columns
+
+# Client-side mode (CHI_CLIENTSIDE=1): precomputed results for every pair are sent with the page and callbacks run in the browser
+CLIENTSIDE = os.environ.get("CHI_CLIENTSIDE") == "1"
+
+# Long-running (background) callbacks such as the permutation test run in separate processes
+# With CHI_CELERY_BROKER set (e.g. redis://localhost:6379/0) they are queued to Celery workers: celery -A chi_controller.celery_app worker
+# Otherwise each job is forked from the web process with its state kept on disk - fine for the development server, but a job forked
+# from a gunicorn worker while another of its threads holds a lock (dataset, cache or metrics) inherits that lock held and can hang
+CELERY_BROKER = os.environ.get("CHI_CELERY_BROKER")
+if CELERY_BROKER:
+    from celery import Celery
+    celery_app = Celery(__name__, broker=CELERY_BROKER, backend=os.environ.get("CHI_CELERY_BACKEND", CELERY_BROKER))
+    background_callback_manager = CeleryManager(celery_app)
+else:
+    celery_app = None
+    background_callback_manager = DiskcacheManager(diskcache.Cache(os.path.join("data", ".cache", "callbacks")))
 
 # Specify HTML <head> elements
 app = Dash(__name__,
            title="Association of categorical variables",
            update_title=None,
+           background_callback_manager=background_callback_manager,
            external_stylesheets=[dbc.themes.BOOTSTRAP, dbc.icons.BOOTSTRAP],
            meta_tags=[{"name": "viewport",
                        "content": "width=device-width, initial-scale=1.0, maximum-scale=1.0"}])
 
+# Latency, payload size and in-flight request metrics for every request, served in Prometheus format at /metrics
+chi_metrics.init_app(app.server, lambda: app.callback_map)
+
+# Formatting shared by the result DataTables - these stay in the layout and callbacks only update their data and columns
+table_props = dict(data=[],
+                   columns=[],
+                   style_header={"fontWeight": "bold"},
+                   style_table={"width": "70%"},
+                   style_cell={"minWidth": "120px",
+                               "width": "120px",
+                               "maxWidth": "120px",
+                               "font-family": "Regular"},
+                   fill_width=False,
+                   cell_selectable=False)
+
 # Specify app layout (HTML <body> elements) using dash.html, dash.dcc and dash_bootstrap_components
 # All component IDs should relate to the Input or Output of callback functions in *_controller.py
-app.layout = dbc.Container([
-    # Row - User Input, Results and Conclusion
-    dbc.Row([
-        dbc.Col([
-            html.H4("Variables"),
-            html.Div([
-                dbc.Label("Dependent variable (y axis)",
+def serve_layout():
+    dataset = default_dataset()
+    return dbc.Container([
+        # Row - Dataset selection
+        dbc.Row([
+            dbc.Col([
+                dbc.Label("Dataset",
                           className="label",
-                          html_for="dependent"),
-                dbc.Select(id="dependent",
-                           options=[{"label": x, "value": x}
-                                     for x in chi_happy.columns[1:7]],
-                           value="UK_citizen"),
-                dbc.FormFeedback(
-                    "Dependent variable must be different to independent variable",
-                    type="invalid")
-            ], **{"aria-live": "polite"}),
-            html.Div([
-                dbc.Label("Independent variable (x axis)",
-                          className="label",
-                          html_for="independent"),
-                dbc.Select(id="independent",
-                           options=[{"label": x, "value": x}
-                                     for x in chi_happy.columns[1:7]],
-                           value="Sex")
-            ], **{"aria-live": "polite"}),
-            html.Div([
-                dbc.Button(id="submit",
-                           n_clicks=0,
-                           children="Update results",
-                           class_name="button",
-                           style={"width": 150})
-            ], className="d-flex justify-content-center")
-        ], xs=12, sm=6, md=3),
-        dbc.Col([
-            html.Div([
-                html.H4("Results"),
-                html.P([
-                    html.Span("P value: ", className="bold-p"),
-                    html.Span(id="p-value"),
-                    dcc.Store(id="p-store")
+                          html_for="dataset"),
+                dbc.Select(id="dataset",
+                           options=[{"label": name.replace("_", " "), "value": name}
+                                    for name in chi_datasets.names()],
+                           value=dataset)
+            ], xs=12, sm=6, md=3)
+        ]),
+        # Everything below is replaced when another dataset is selected
+        html.Div(id="dataset-content",
+                 children=dataset_content(dataset))
+    ], fluid=True)
+
+
+# Layout for a dataset, or a message when there is nothing that can be shown
+def dataset_content(dataset):
+    if dataset is None:
+        return [html.P("No survey files found in the data folder")]
+    try:
+        return dataset_layout(dataset)
+    except ValueError as e:
+        return [html.P(str(e))]
+
+
+# Variables, results, tables and figures for one dataset
+def dataset_layout(dataset):
+    # Figures and client-side data are prebuilt (see chi_model.initial_layout_data), so building the layout computes nothing
+    layout_data = initial_layout_data(dataset)
+    columns = selectable_columns(dataset)
+    dependent, independent = initial_pair(dataset)
+    return [
+        # Row - User Input, Results and Conclusion
+        dbc.Row([
+            dbc.Col([
+                html.H4("Variables"),
+                html.Div([
+                    dbc.Label("Dependent variable (y axis)",
+                              className="label",
+                              html_for="dependent"),
+                    dbc.Select(id="dependent",
+                               options=[{"label": x, "value": x}
+                                         for x in columns],
+                               value=dependent),
+                    dbc.FormFeedback(
+                        "Dependent variable must be different to independent variable",
+                        type="invalid")
                 ], **{"aria-live": "polite"}),
+                html.Div([
+                    dbc.Label("Independent variable (x axis)",
+                              className="label",
+                              html_for="independent"),
+                    dbc.Select(id="independent",
+                               options=[{"label": x, "value": x}
+                                         for x in columns],
+                               value=independent)
+                ], **{"aria-live": "polite"}),
+                html.Div([
+                    dbc.Button(id="submit",
+                               n_clicks=0,
+                               children="Update results",
+                               class_name="button",
+                               style={"width": 150})
+                ], className="d-flex justify-content-center")
+            ], xs=12, sm=6, md=3),
+            dbc.Col([
+                html.Div([
+                    html.H4("Results"),
+                    html.P([
+                        html.Span("P value: ", className="bold-p"),
+                        html.Span(id="p-value"),
+                        dcc.Store(id="p-store")
+                    ], **{"aria-live": "polite"}),
+                    html.Br(),
+                    html.P("Null hypothesis", className="bold-p"),
+                    html.P(id="null-hyp", **{"aria-live": "polite"}),
+                    html.Br(),
+                    html.P("Alternative hypothesis", className="bold-p"),
+                    html.P(id="alt-hyp", **{"aria-live": "polite"}),
+                    html.Br(),
+                    # Permutation test - p value without the large-sample approximation, for sparse tables
+                    html.P("Permutation test", className="bold-p"),
+                    dbc.Label("Number of permutations",
+                              className="label",
+                              html_for="permutations"),
+                    dbc.Input(id="permutations",
+                              type="number",
+                              min=100,
+                              max=1000000,
+                              step=100,
+                              value=10000),
+                    dbc.Label("Random seed",
+                              className="label",
+                              html_for="seed"),
+                    dbc.Input(id="seed",
+                              type="number",
+                              min=0,
+                              step=1,
+                              value=0),
+                    html.Div([
+                        dbc.Button(id="permutation-run",
+                                   children="Run permutation test",
+                                   class_name="button",
+                                   style={"width": 220}),
+                        dbc.Button(id="permutation-cancel",
+                                   children="Cancel",
+                                   class_name="button",
+                                   disabled=True,
+                                   style={"width": 150})
+                    ], className="d-flex justify-content-center"),
+                    dbc.Progress(id="permutation-progress",
+                                 value=0,
+                                 max=1),
+                    html.P([
+                        html.Span("Permutation p value: ", className="bold-p"),
+                        html.Span(id="permutation-p")
+                    ], **{"aria-live": "polite"}),
+                    # The statistic is the one behind the P value above - only the distribution it is compared with differs
+                    html.P("Uses the same Chi-squared statistic as the P value above, but compares it with the statistic for "
+                           "shuffled data instead of a Chi-squared distribution with (rows × columns) degrees of freedom, "
+                           "so the two p values can differ.",
+                           className="small")
+                ], id="results", style={"display": "none"})
+            ], xs=12, md=5),
+            dbc.Col([
+                html.H4("Conclusion"),
+                dbc.Label("Based on the results obtained, should you accept or reject the null hypothesis at the 95% confidence level?",
+                          className="label",
+                          html_for="accept-reject95"),
+                dbc.Select(id="accept-reject95",
+                           options=[{"label": "Accept the null hypothesis",
+                                     "value": "accept"},
+                                    {"label": "Reject the null hypothesis",
+                                     "value": "reject"}],
+                           value=None,
+                           disabled=True),
                 html.Br(),
-                html.P("Null hypothesis", className="bold-p"),
-                html.P(id="null-hyp", **{"aria-live": "polite"}),
+                html.P(id="conclusion95", children=[], **{"aria-live": "polite"}),
                 html.Br(),
-                html.P("Alternative hypothesis", className="bold-p"),
-                html.P(id="alt-hyp", **{"aria-live": "polite"})
-            ], id="results", style={"display": "none"})
-        ], xs=12, md=5),
-        dbc.Col([
-            html.H4("Conclusion"),
-            dbc.Label("Based on the results obtained, should you accept or reject the null hypothesis at the 95% confidence level?",
-                      className="label",
-                      html_for="accept-reject95"),
-            dbc.Select(id="accept-reject95",
-                       options=[{"label": "Accept the null hypothesis",
-                                 "value": "accept"},
-                                {"label": "Reject the null hypothesis",
-                                 "value": "reject"}],
-                       value=None,
-                       disabled=True),
-            html.Br(),
-            html.P(id="conclusion95", children=[], **{"aria-live": "polite"}),
-            html.Br(),
-            dbc.Label("What about at the 99% confidence level?",
-                      className="label",
-                      html_for="accept-reject99"),
-            dbc.Select(id="accept-reject99",
-                       options=[{"label": "Accept the null hypothesis",
-                                 "value": "accept"},
-                                {"label": "Reject the null hypothesis",
-                                 "value": "reject"}],
-                       value=None,
-                       disabled=True),
-            html.Br(),
-            html.P(id="conclusion99", children=[], **{"aria-live": "polite"})
-        ], xs=12, sm=6, md=4)
-    ]),
-    # Row - Graph and DataTables
-    dbc.Row([
-        dbc.Col([
-            # Graph components are placed inside a Div with role="img" to manage UX for screen reader users
-            html.Div([
-                dcc.Graph(id="graph",
-                          figure=create_blank_fig(),
-                          config={"displayModeBar": False,
-                                  "doubleClick": False,
-                                  "editable": False,
-                                  "scrollZoom": False,
-                                  "showAxisDragHandles": False})
-            ], role="img", **{"aria-hidden": "true"}),
-            html.Br(),
-            # A second Div is used to associate alt text with the relevant Graph component to manage the experience for screen reader users, styled using CSS class sr-only
-            html.Div(id="sr-bar",
-                     children=["Bar chart of dependent variable UK citizen for independent variable Sex"],
-                     className="sr-only",
-                     **{"aria-live": "polite"})
-        ], xs=12, md=6),
-        dbc.Col([
-            html.Div([
-                html.H5("Observed vs expected proportions"),
-                html.Div(id="table-observed-pc", children=[]),
+                dbc.Label("What about at the 99% confidence level?",
+                          className="label",
+                          html_for="accept-reject99"),
+                dbc.Select(id="accept-reject99",
+                           options=[{"label": "Accept the null hypothesis",
+                                     "value": "accept"},
+                                    {"label": "Reject the null hypothesis",
+                                     "value": "reject"}],
+                           value=None,
+                           disabled=True),
                 html.Br(),
-                html.H5("Observed values"),
-                html.Div(id="table-observed", children=[]),
+                html.P(id="conclusion99", children=[], **{"aria-live": "polite"})
+            ], xs=12, sm=6, md=4)
+        ]),
+        # Row - Graph and DataTables
+        dbc.Row([
+            dbc.Col([
+                # Graph components are placed inside a Div with role="img" to manage UX for screen reader users
+                html.Div([
+                    dcc.Graph(id="graph",
+                              figure=layout_data["figure"],
+                              config={"displayModeBar": False,
+                                      "doubleClick": False,
+                                      "editable": False,
+                                      "scrollZoom": False,
+                                      "showAxisDragHandles": False})
+                ], role="img", **{"aria-hidden": "true"}),
                 html.Br(),
-                html.H5("Expected values"),
-                html.Div(id="table-expected", children=[]),
-            ])
-        ], style={"padding-left": 30}, xs=12, md=6)
-    ])
-], fluid=True)
+                # A second Div is used to associate alt text with the relevant Graph component to manage the experience for screen reader users, styled using CSS class sr-only
+                html.Div(id="sr-bar",
+                         children=[f"Bar chart of dependent variable {dependent.replace('_', ' ')} for independent variable {independent.replace('_', ' ')}"],
+                         className="sr-only",
+                         **{"aria-live": "polite"})
+            ], xs=12, md=6),
+            dbc.Col([
+                html.Div([
+                    html.H5("Observed vs expected proportions"),
+                    dash_table.DataTable(id="table-observed-pc", **table_props),
+                    html.Br(),
+                    html.H5("Observed values"),
+                    dash_table.DataTable(id="table-observed", **table_props),
+                    html.Br(),
+                    html.H5("Expected values"),
+                    dash_table.DataTable(id="table-expected", **table_props),
+                    html.Br(),
+                    html.H5("Results by sample"),
+                    dbc.Switch(id="stratify",
+                               label="Show results for each sample",
+                               value=False),
+                    html.P(id="cmh-result", **{"aria-live": "polite"}),
+                    html.Div(id="table-strata", children=[])
+                ])
+            ], style={"padding-left": 30}, xs=12, md=6)
+        ]),
+        # Row - Association between every pair of variables
+        dbc.Row([
+            dbc.Col([
+                html.H4("Association between variables"),
+                html.Div([
+                    dcc.Graph(id="heatmap",
+                              figure=layout_data["heatmap"],
+                              config={"displayModeBar": False,
+                                      "doubleClick": False,
+                                      "editable": False,
+                                      "scrollZoom": False,
+                                      "showAxisDragHandles": False})
+                ], role="img", **{"aria-hidden": "true"}),
+                html.Div(children=["Heatmap of Cramér's V for every pair of variables"],
+                         className="sr-only")
+            ], xs=12, md=8)
+        ]),
+        # Precomputed results for every pair, only populated in client-side mode
+        dcc.Store(id="pair-store",
+                  data=layout_data["pair_store"] if CLIENTSIDE else None)
+    ]
+
+
+# Layout is built on each page load so the graph and client-side data reflect rows ingested while the app is running
+app.layout = serve_layout
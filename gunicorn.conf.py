@@ -0,0 +1,46 @@
+# Production server settings: gunicorn -c gunicorn.conf.py wsgi:server
+# The app is loaded once in the master process (preload_app) and worker processes are forked from it,
+# so the dataset, encoded columns and precomputed results are shared copy-on-write rather than loaded per worker
+import gc
+import os
+
+
+# CPUs this process may use - os.cpu_count() reports the host's CPUs, not the container's limit
+# The cgroup v2 CPU quota (docker --cpus, Kubernetes CPU limits) is used where set, otherwise the CPUs the process is pinned to
+def available_cpus():
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return max(1, int(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+bind = os.environ.get("CHI_BIND", "0.0.0.0:8080")
+workers = int(os.environ.get("CHI_WORKERS", available_cpus()))
+threads = int(os.environ.get("CHI_THREADS", 4))
+worker_class = "gthread"
+preload_app = True
+
+# Graceful reload (kill -HUP <master pid>): new workers are forked and old ones finish in-flight requests first
+graceful_timeout = 30
+timeout = 60
+keepalive = 5
+
+
+# Compute results for every pair once in the master, after the app is loaded and before any worker is forked,
+# so workers share them (and the imported scipy) instead of each computing its own copy
+def when_ready(server):
+    import chi_model
+    dataset = chi_model.default_dataset()
+    if dataset is not None:
+        chi_model.refresh_results(dataset)
+
+
+# Freeze objects created while preloading so garbage collection in workers does not touch (and copy) shared pages
+def pre_fork(server, worker):
+    gc.freeze()
@@ -0,0 +1,162 @@
+// Static front end written by chi_export.py - renders the exported results for each pair without a Python server
+// datasets.json lists the datasets, <dataset>/index.json the columns and initial figures, and each pair has its own file
+(function () {
+    var config = {displayModeBar: false,
+                  doubleClick: false,
+                  editable: false,
+                  scrollZoom: false,
+                  showAxisDragHandles: false};
+    var index = null;
+    var dataset = null;
+    var pair = null;
+
+    function $(id) {
+        return document.getElementById(id);
+    }
+
+    function getJSON(path) {
+        return fetch(path).then(function (response) {
+            if (!response.ok) {
+                throw new Error(path + " returned " + response.status);
+            }
+            return response.json();
+        });
+    }
+
+    function options(select, items, value) {
+        select.innerHTML = "";
+        items.forEach(function (item) {
+            var option = document.createElement("option");
+            option.value = item.value;
+            option.textContent = item.label;
+            select.appendChild(option);
+        });
+        select.value = value;
+    }
+
+    // DataTable cells as the server formats them - proportion columns use the .2% specifier
+    function cell(value, column) {
+        if (column.format && column.format.specifier === ".2%") {
+            return (value * 100).toFixed(2) + "%";
+        }
+        return value;
+    }
+
+    // Cell text is set with textContent so category names are never parsed as HTML
+    function row(tag, values) {
+        var tr = document.createElement("tr");
+        values.forEach(function (value) {
+            var td = document.createElement(tag);
+            td.style.minWidth = "120px";
+            td.textContent = value;
+            tr.appendChild(td);
+        });
+        return tr;
+    }
+
+    function table(container, result) {
+        var element = document.createElement("table");
+        element.className = "table table-sm";
+        element.style.width = "auto";
+        var head = document.createElement("thead");
+        head.appendChild(row("th", result.columns.map(function (column) { return column.name; })));
+        element.appendChild(head);
+        var body = document.createElement("tbody");
+        result.data.forEach(function (record) {
+            body.appendChild(row("td", result.columns.map(function (column) { return cell(record[column.id], column); })));
+        });
+        element.appendChild(body);
+        container.innerHTML = "";
+        container.appendChild(element);
+    }
+
+    // Conclusion spans exported from accept_or_reject95/99
+    function conclusion(container, spans) {
+        container.innerHTML = "";
+        spans.forEach(function (props) {
+            var span = document.createElement("span");
+            span.textContent = [].concat(props.children).join("");
+            if (props.className) {
+                span.className = props.className;
+            }
+            container.appendChild(span);
+        });
+    }
+
+    function resetConclusions() {
+        ["95", "99"].forEach(function (level) {
+            var select = $("accept-reject" + level);
+            select.value = "";
+            select.disabled = pair === null;
+            $("conclusion" + level).innerHTML = "";
+        });
+    }
+
+    function loadDataset(name) {
+        return getJSON(name + "/index.json").then(function (data) {
+            index = data;
+            dataset = name;
+            pair = null;
+            var columns = data.columns.map(function (column) {
+                return {label: column.replace(/_/g, " "), value: column};
+            });
+            options($("dependent"), columns, data.dependent);
+            options($("independent"), columns, data.independent);
+            $("dependent").classList.remove("is-invalid");
+            $("results").style.display = "none";
+            ["table-observed-pc", "table-observed", "table-expected"].forEach(function (id) {
+                $(id).innerHTML = "";
+            });
+            $("sr-bar").textContent = data.sr_text;
+            resetConclusions();
+            Plotly.newPlot("graph", data.figure.data, data.figure.layout, config);
+            Plotly.newPlot("heatmap", data.heatmap.data, data.heatmap.layout, config);
+        });
+    }
+
+    function submit() {
+        var dependent = $("dependent").value;
+        var independent = $("independent").value;
+        if (dependent === independent) {
+            $("dependent").classList.add("is-invalid");
+            return;
+        }
+        $("dependent").classList.remove("is-invalid");
+        var requested = dataset;
+        getJSON(dataset + "/" + index.files[dependent + "|" + independent]).then(function (data) {
+            // A response for a dataset that has since been replaced is ignored
+            if (requested !== dataset) {
+                return;
+            }
+            pair = data;
+            Plotly.react("graph", data.figure.data, data.figure.layout, config);
+            $("sr-bar").textContent = data.sr_text;
+            $("p-value").textContent = data.p_text;
+            $("null-hyp").textContent = data.null_hyp;
+            $("alt-hyp").textContent = data.alt_hyp;
+            $("results").style.display = "";
+            Object.keys(data.tables).forEach(function (id) {
+                table($(id), data.tables[id]);
+            });
+            resetConclusions();
+        }).catch(console.error);
+    }
+
+    document.addEventListener("DOMContentLoaded", function () {
+        getJSON("datasets.json").then(function (data) {
+            options($("dataset"), data.datasets, data.default);
+            return loadDataset(data.default);
+        }).catch(console.error);
+        $("dataset").addEventListener("change", function (event) {
+            loadDataset(event.target.value).catch(console.error);
+        });
+        $("submit").addEventListener("click", submit);
+        ["95", "99"].forEach(function (level) {
+            $("accept-reject" + level).addEventListener("change", function (event) {
+                if (pair !== null && event.target.value) {
+                    conclusion($("conclusion" + level), pair.conclusions[level][event.target.value]);
+                }
+            });
+        });
+    });
+})();
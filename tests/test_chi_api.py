@@ -0,0 +1,50 @@
+# /api/chi2 must return the results calc_chi2_ind gives the UI for every pair, as JSON and as NDJSON
+# Run from the repository root: python -m pytest
+import json
+from itertools import permutations
+import numpy as np
+import pytest
+import chi_controller
+import chi_model
+
+PAIRS = list(permutations(chi_model.selectable_columns(), 2))
+
+
+def api_results(accept):
+    client = chi_controller.app.server.test_client()
+    response = client.post("/api/chi2",
+                           json={"pairs": [{"dependent": y, "independent": x} for y, x in PAIRS]},
+                           headers={"Accept": accept})
+    assert response.status_code == 200
+    if accept == "application/x-ndjson":
+        assert response.mimetype == "application/x-ndjson"
+        return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    return response.get_json()["results"]
+
+
+def assert_results_match(results):
+    assert len(results) == len(PAIRS)
+    for result, (y, x) in zip(results, PAIRS):
+        ct, _, _, _, _, _, chi2, p, dof, expected = chi_model.calc_chi2_ind(y, x)
+        assert (result["dataset"], result["dependent"], result["independent"]) == (chi_model.DATASET, y, x)
+        assert result["dependent_categories"] == [str(c) for c in ct.index[:-1]], (y, x)
+        assert result["independent_categories"] == [str(c) for c in ct.columns[:-1]], (y, x)
+        assert np.array_equal(result["counts"], ct.values[:-1, :-1]), (y, x)
+        assert np.allclose(result["expected"], expected[:-1, :-1], rtol=1e-12, atol=0), (y, x)
+        assert result["chi2"] == pytest.approx(chi2, rel=1e-12), (y, x)
+        assert result["p"] == pytest.approx(p, rel=1e-12), (y, x)
+        assert result["dof"] == dof, (y, x)
+
+
+# Results are computed in one pass, taken from the UI's results or from the batch cache - each source is checked
+@pytest.mark.parametrize("accept", ["application/json", "application/x-ndjson"])
+def test_results_match_calc_chi2_ind(accept):
+    chi_model.chi_cache.clear()
+    chi_model.batch_cache.clear()
+    computed = api_results(accept)
+    assert_results_match(computed)
+    assert api_results(accept) == computed
+    chi_model.batch_cache.clear()
+    for y, x in PAIRS:
+        chi_model.calc_chi2_ind(y, x)
+    assert_results_match(api_results(accept))
@@ -0,0 +1,104 @@
+# Counts kept by SurveyData must match a fresh crosstab of the CSV after ingest, rows appended by another process and a restart
+# Run from the repository root: python -m pytest
+from itertools import combinations
+import numpy as np
+import pandas as pd
+import pytest
+from chi_data import SurveyData
+
+
+def survey(n_rows, seed):
+    rng = np.random.default_rng(seed)
+    frame = pd.DataFrame({"sample": rng.integers(1, 12, n_rows).astype(str),
+                          "Sex": rng.choice(["F", "M"], n_rows),
+                          "Residence": rng.choice(["UK", "EU", "International"], n_rows)})
+    # Missing values are skipped for the pairs they appear in
+    frame.loc[rng.random(n_rows) < 0.05, "Residence"] = np.nan
+    return frame
+
+
+def assert_counts_match(data, path):
+    frame = pd.read_csv(path, dtype=str)
+    assert data.n_rows == len(frame)
+    for y, x in combinations(frame.columns, 2):
+        if not (data.paired(y) and data.paired(x)):
+            with pytest.raises(ValueError):
+                data.pair_counts(y, x)
+            continue
+        counts, y_labels, x_labels = data.pair_counts(y, x)
+        expected = pd.crosstab(frame[y], frame[x]).reindex(index=y_labels, columns=x_labels, fill_value=0)
+        assert np.array_equal(counts, expected.values), (y, x)
+    for col in frame.columns:
+        categories = data.categories[data.columns.index(col)]
+        decoded = [categories[code] if code >= 0 else None for code in data.codes(col)]
+        assert decoded == [None if pd.isna(v) else v for v in frame[col]], col
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = tmp_path / "survey.csv"
+    survey(500, seed=0).to_csv(path, index=False)
+    return str(path)
+
+
+def test_counts_after_load(csv_path, tmp_path):
+    data = SurveyData.load(csv_path, cache_dir=str(tmp_path / "cache"), chunksize=128)
+    assert_counts_match(data, csv_path)
+
+
+def test_counts_after_ingest(csv_path, tmp_path):
+    data = SurveyData.load(csv_path, cache_dir=str(tmp_path / "cache"), chunksize=128)
+    version = data.version
+    assert data.append_csv(survey(200, seed=1).to_csv(index=False).encode()) == 200
+    assert data.version > version
+    assert_counts_match(data, csv_path)
+
+
+def test_ingest_rejects_other_columns(csv_path, tmp_path):
+    data = SurveyData.load(csv_path, cache_dir=str(tmp_path / "cache"))
+    with open(csv_path, "rb") as f:
+        before = f.read()
+    with pytest.raises(ValueError):
+        data.append_csv(b"Sex,Other\nF,x\n")
+    with open(csv_path, "rb") as f:
+        assert f.read() == before
+    assert_counts_match(data, csv_path)
+
+
+def test_counts_after_external_append(csv_path, tmp_path):
+    data = SurveyData.load(csv_path, cache_dir=str(tmp_path / "cache"))
+    survey(300, seed=2).to_csv(csv_path, mode="a", header=False, index=False)
+    assert data.sync()
+    assert_counts_match(data, csv_path)
+
+
+def test_counts_after_restart(csv_path, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    data = SurveyData.load(csv_path, cache_dir=cache_dir)
+    data.append_csv(survey(100, seed=3).to_csv(index=False).encode())
+    # Rows appended while the app is stopped are applied from the persisted counts on the next load
+    survey(100, seed=4).to_csv(csv_path, mode="a", header=False, index=False)
+    restarted = SurveyData.load(csv_path, cache_dir=cache_dir)
+    assert_counts_match(restarted, csv_path)
+
+
+def test_counts_after_edit(csv_path, tmp_path):
+    data = SurveyData.load(csv_path, cache_dir=str(tmp_path / "cache"))
+    codes = data.codes("sample")
+    before = np.array(codes)
+    # An edit that is not an append is read again from the start - files already mapped stay readable
+    survey(400, seed=5).to_csv(csv_path, index=False)
+    assert data.sync()
+    assert_counts_match(data, csv_path)
+    assert np.array_equal(codes, before)
+
+
+def test_counts_after_widening(csv_path, tmp_path):
+    data = SurveyData.load(csv_path, cache_dir=str(tmp_path / "cache"))
+    codes = data.codes("sample")
+    before = np.array(codes)
+    rows = pd.DataFrame({"sample": [f"s{i}" for i in range(200)], "Sex": "F", "Residence": "UK"})
+    data.append_csv(rows.to_csv(index=False).encode())
+    assert data.dtypes[data.columns.index("sample")] == np.int16
+    assert_counts_match(data, csv_path)
+    assert np.array_equal(codes, before)
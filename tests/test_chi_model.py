@@ -0,0 +1,52 @@
+# Precomputed results must match the original per-request computation (pd.crosstab + chi2_contingency on the raw CSV)
+# Run from the repository root: python -m pytest
+from itertools import permutations
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.stats as stat
+import chi_model
+
+chi_happy = pd.read_csv("data/chi_happy.csv")
+
+
+# calc_chi2_ind as it was before results were precomputed
+def reference_chi2_ind(y, x):
+    dff = chi_happy[[y, x]].dropna().reset_index(drop=True)
+    ct = pd.crosstab(index=dff[y], columns=dff[x], margins=True, margins_name="Expected")
+    ct_norm = pd.crosstab(index=dff[y], columns=dff[x], normalize="columns", margins=True, margins_name="Expected")
+    ct_t = ct_norm.transpose()
+    ct_table = ct.transpose()
+    chi2, p, dof, expected = stat.chi2_contingency(ct, correction=True)
+    return ct, ct_norm, ct_t, ct_table, dff[y].unique(), dff[x].unique(), chi2, p, dof, expected
+
+
+@pytest.mark.parametrize("y, x", list(permutations(chi_model.selectable_columns(), 2)))
+def test_calc_chi2_ind_matches_reference(y, x):
+    ct, ct_norm, ct_t, ct_table, dep_cat, ind_cat, chi2, p, dof, expected = chi_model.calc_chi2_ind(y, x)
+    ref = reference_chi2_ind(y, x)
+    for table, ref_table in zip((ct, ct_norm, ct_t, ct_table), ref[:4]):
+        pd.testing.assert_frame_equal(table, ref_table, check_exact=True)
+    assert sorted(dep_cat) == sorted(ref[4])
+    assert sorted(ind_cat) == sorted(ref[5])
+    assert (chi2, p, dof) == ref[6:9]
+    assert np.array_equal(expected, ref[9])
+
+
+def test_every_pair_is_covered():
+    assert len(list(permutations(chi_model.selectable_columns(), 2))) == 30
+
+
+# The heatmap shows the same p value as the results for the pair
+def test_association_p_values_match_results():
+    _, p_values = chi_model.compute_association(chi_model.selectable_columns())
+    for y, x in permutations(chi_model.selectable_columns(), 2):
+        assert p_values.loc[y, x] == pytest.approx(chi_model.calc_chi2_ind(y, x)[7], rel=1e-12), (y, x)
+
+
+# The permutation test uses the same statistic as the results, only compared with a different distribution
+def test_permutation_statistic_matches_results():
+    data = chi_model.chi_datasets[chi_model.DATASET]
+    for y, x in permutations(chi_model.selectable_columns(), 2):
+        counts = data.pair_counts(y, x)[0].astype(float)
+        assert chi_model.pearson_chi2(counts) == pytest.approx(chi_model.calc_chi2_ind(y, x)[6], rel=1e-12), (y, x)
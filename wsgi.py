@@ -0,0 +1,12 @@
+# WSGI entry point for production serving: gunicorn -c gunicorn.conf.py wsgi:server
+# Importing chi_controller loads the dataset and registers the callbacks - results are computed before workers are forked (see gunicorn.conf.py)
+import time
+
+started = time.perf_counter()
+
+import chi_metrics
+from chi_controller import app
+
+chi_metrics.record_startup(time.perf_counter() - started)
+
+server = app.server